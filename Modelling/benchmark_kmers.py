@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time of the k-mer precomputations (KmerExtractor, FramedKmerExtractor) per k, comparing the
+former per-position implementation (dict lookup of every k-mer, kept below for reference) with
+the rolling integer code version, dense and CSR (sparse=True).
+
+Uses the utrs of Data/data_dict.pkl (mpra training set, see README), or sampled utrs with
+MPRA-like lengths. Dense runs whose matrix would exceed --max-dense-mb are skipped; counts of
+all versions are compared on the first --n-check utrs.
+
+Usage: python benchmark_kmers.py [--n 20000] [--k-min 4] [--k-max 8] [--max-dense-mb 1024]
+"""
+
+import os
+import time
+import pickle
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import utils_data
+
+# The former per-position implementations (without divide_counts, which had no effect)
+class OldKmerExtractor:
+
+    def __init__(self, k, jump=False):
+        self.k = k
+        kmers = [''.join(i) for i in itertools.product(["A","C","T","G"], repeat = self.k)]
+        self.n = len(kmers)
+        self.kmer_dict = {kmers[k]:k for k in range(self.n)}
+        self.jump = jump
+
+    def extract(self, seq):
+        i = 0
+        arr = np.zeros(self.n)
+        while i < len(seq) - (self.k - 1):
+            arr[self.kmer_dict[seq[i:i+self.k]]] = arr[self.kmer_dict[seq[i:i+self.k]]] + 1
+            if self.jump:
+                i = i + self.k
+            else:
+                i += 1
+        return arr
+
+class OldFramedKmerExtractor(OldKmerExtractor):
+
+    def extract(self, seq):
+        i = 1
+        arrays = [np.zeros(self.n), np.zeros(self.n), np.zeros(self.n)]
+        while i <= len(seq) - (self.k - 1):
+            j = len(seq) - (self.k - 1) - i
+            arrays[i % 3][self.kmer_dict[seq[j:j+self.k]]] = arrays[i % 3][self.kmer_dict[seq[j:j+self.k]]] + 1
+            if self.jump:
+                i = i + self.k
+            else:
+                i += 1
+        return np.concatenate(arrays)
+
+def load_utrs(data_dict_file, n):
+    if not os.path.exists(data_dict_file):
+        print("{} not found, using {} sampled utrs".format(data_dict_file, n))
+        rng = np.random.RandomState(1337)
+        lengths = np.where(rng.rand(n) < 0.5, 50, rng.randint(25, 101, n))
+        return ["".join(rng.choice(list("ACGT"), length)) for length in lengths]
+    with open(data_dict_file, "rb") as handle:
+        data_dict = pickle.load(handle)
+    utrs = pd.concat([data_dict["mpra"]["utr"], data_dict["varlen_mpra"]["utr"]])
+    return list(utrs[utrs.str.fullmatch("[ACGT]+")].values[:n])
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the k-mer precomputations.")
+    parser.add_argument("--data-dict", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "..", "Data", "data_dict.pkl"))
+    parser.add_argument("--n", type=int, default=20000, help="Number of utrs.")
+    parser.add_argument("--k-min", type=int, default=4)
+    parser.add_argument("--k-max", type=int, default=8)
+    parser.add_argument("--max-dense-mb", type=float, default=1024)
+    parser.add_argument("--n-check", type=int, default=200, help="Utrs compared across versions.")
+    args = parser.parse_args()
+
+    utrs = load_utrs(args.data_dict, args.n)
+    df = pd.DataFrame({"utr": utrs})
+    check = utrs[:args.n_check]
+    print("{} utrs, mean length {:.1f}".format(len(utrs), np.mean([len(utr) for utr in utrs])))
+    print("{:22s} {:>2s} {:>10s} {:>10s} {:>10s} {:>9s}".format("extractor", "k", "old s", "dense s", "csr s", "speedup"))
+    for old_class, new_class in [(OldKmerExtractor, utils_data.KmerExtractor),
+                                 (OldFramedKmerExtractor, utils_data.FramedKmerExtractor)]:
+        for k in range(args.k_min, args.k_max + 1):
+            old = old_class(k)
+            dense = new_class("utr", "kmers", k, divide_counts=False)
+            csr = new_class("utr", "kmers", k, divide_counts=False, sparse=True)
+            # same counts in every version
+            expected = np.stack([old.extract(utr) for utr in check])
+            assert np.array_equal(dense.matrix(check), expected)
+            assert np.array_equal(csr.matrix(check).toarray(), expected)
+            fits = len(utrs)*dense.dims[0]*8/2**20 <= args.max_dense_mb
+            old_time = dense_time = None
+            if fits:
+                _, old_time = timed(lambda: df["utr"].apply(old.extract))
+                _, dense_time = timed(lambda: dense(df))
+            _, csr_time = timed(lambda: csr(df))
+            fastest = min(t for t in [dense_time, csr_time] if t is not None)
+            print("{:22s} {:2d} {:>10s} {:>10s} {:10.3f} {:>9s}".format(
+                new_class.__name__, k,
+                "skipped" if old_time is None else "{:.3f}".format(old_time),
+                "skipped" if dense_time is None else "{:.3f}".format(dense_time),
+                csr_time, "-" if old_time is None else "{:.1f}x".format(old_time/fastest)))
+
+if __name__ == "__main__":
+    main()
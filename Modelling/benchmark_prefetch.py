@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Steps/sec of a DataSequence training loop with and without background prefetching.
+
+Uses the combined MPRA training set of Model_Training.ipynb (egfp_unmod_1 50nt and random
+variable length utrs from Data/data_dict.pkl, see README) with the same encoding functions.
+Every step consumes one batch and then trains the Framepool model on it (--keras), or
+simulates the model step by sleeping --step-ms (like the GIL-free model, the loader can work
+meanwhile). Without data_dict, sequences with MPRA-like lengths are sampled.
+
+Usage: python benchmark_prefetch.py [--steps 300] [--step-ms 20] [--workers 2] [--prefetch 4] [--keras]
+"""
+
+import os
+import time
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import utils_data
+
+# Training set like in Model_Training.ipynb
+def mpra_training_set(data_dict_file, n_sampled):
+    if not os.path.exists(data_dict_file):
+        print("{} not found, using {} sampled utrs".format(data_dict_file, n_sampled))
+        rng = np.random.RandomState(1337)
+        lengths = np.where(rng.rand(n_sampled) < 0.5, 50, rng.randint(25, 101, n_sampled))
+        return pd.DataFrame({"utr": ["".join(rng.choice(list("ACGT"), length)) for length in lengths],
+                             "rl": rng.rand(n_sampled)*8,
+                             "library": np.where(lengths == 50, "egfp_unmod_1", "random")})
+    with open(data_dict_file, "rb") as handle:
+        data_dict = pickle.load(handle)
+    mpra_data = data_dict["mpra"]
+    train_data_50 = mpra_data[(mpra_data.set == "train") & (mpra_data.library == "egfp_unmod_1")]
+    mpra_data_varlen = data_dict["varlen_mpra"]
+    train_data_100 = mpra_data_varlen[(mpra_data_varlen.set == "train") & (mpra_data_varlen.library == "random")]
+    return pd.concat([train_data_100[["utr", "rl", "library"]], train_data_50[["utr", "rl", "library"]]])
+
+def build_sequence(df, args, prefetch, processes=False):
+    one_hot_fn = utils_data.OneHotEncoder("utr")
+    out_encoding_fn = utils_data.DataFrameExtractor("rl", method="direct")
+    library_fn = utils_data.LibraryEncoder("library", {"egfp_unmod_1":0, "random":1})
+    return utils_data.DataSequence(df, encoding_functions=[one_hot_fn, library_fn],
+                                   output_encoding_fn=out_encoding_fn, batch_size=args.batch_size,
+                                   shuffle=True, prefetch=prefetch, prefetch_workers=args.workers,
+                                   prefetch_processes=processes)
+
+# Runs steps over the sequence (epochs as needed), returns steps/sec
+def run_steps(sequence, steps, train_step):
+    np.random.seed(1337)
+    sequence.on_epoch_end()
+    start = time.perf_counter()
+    done = 0
+    while done < steps:
+        for idx in range(len(sequence)):
+            train_step(sequence[idx])
+            done += 1
+            if done == steps:
+                break
+        sequence.on_epoch_end()
+    elapsed = time.perf_counter() - start
+    sequence.close()
+    return steps/elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DataSequence prefetching.")
+    parser.add_argument("--data-dict", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "..", "Data", "data_dict.pkl"))
+    parser.add_argument("--n-sampled", type=int, default=100000, help="Sampled utrs without data_dict.")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--step-ms", type=float, default=20.0, help="Simulated model step time.")
+    parser.add_argument("--keras", action="store_true", help="Train the Framepool model instead of sleeping.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--prefetch", type=int, default=4, help="Batches built ahead.")
+    args = parser.parse_args()
+
+    df = mpra_training_set(args.data_dict, args.n_sampled)
+    if args.keras:
+        import model
+        utr_model = model.create_frame_slice_model(use_scaling_regression=True, library_size=2)
+        train_step = lambda batch: utr_model.train_on_batch(*batch)
+    else:
+        train_step = lambda batch: time.sleep(args.step_ms/1000)
+
+    print("{} usable cpus".format(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()))
+    # Loader alone (no model step) gives the upper bound of the input pipeline
+    print("{:28s} {:>10s}".format("configuration", "steps/s"))
+    print("{:28s} {:10.1f}".format("loader only", run_steps(build_sequence(df, args, 0), args.steps, lambda batch: None)))
+    configurations = [("no prefetch", 0, False),
+                      ("prefetch {} threads".format(args.workers), args.prefetch, False),
+                      ("prefetch {} processes".format(args.workers), args.prefetch, True)]
+    for name, prefetch, processes in configurations:
+        steps_per_sec = run_steps(build_sequence(df, args, prefetch, processes), args.steps, train_step)
+        print("{:28s} {:10.1f}".format(name, steps_per_sec))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Bump when the stored layout or the key changes, old entries are then ignored
+STORE_VERSION = 1
+
+# Marks parameters that do not go into the key (derived objects such as automata or functions)
+_SKIP = object()
+
+# JSON-able state of a parameter value, or _SKIP
+def param_state(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return [str(value.dtype), list(value.shape),
+                hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()]
+    if isinstance(value, (list, tuple)):
+        return [state for state in map(param_state, value) if state is not _SKIP]
+    if isinstance(value, dict):
+        states = [[repr(key), param_state(item)] for key, item in value.items()]
+        return sorted(state for state in states if state[1] is not _SKIP)
+    return _SKIP
+
+# Columns an encoding function or precomputation reads (its col and *_col attributes)
+def read_columns(fn):
+    return {value for name, value in vars(fn).items()
+            if (name == "col" or name.endswith("_col")) and name != "new_col" and isinstance(value, str)}
+
+# Dataframe columns a precomputation reads
+def input_columns(fn, df):
+    return sorted(column for column in read_columns(fn) if column in df)
+
+# Key of a precomputation over a dataframe: hash of its input columns, its class and parameters.
+# None if the result cannot be keyed (no known input columns or not cacheable)
+def feature_key(fn, df):
+    columns = input_columns(fn, df)
+    if not getattr(fn, "cacheable", True) or len(columns) == 0:
+        return None
+    input_hash = hashlib.sha1(pd.util.hash_pandas_object(df[columns], index=False).values.tobytes()).hexdigest()
+    params = {name: param_state(value) for name, value in vars(fn).items()}
+    params = {name: state for name, state in params.items() if state is not _SKIP}
+    description = {"version": STORE_VERSION, "class": type(fn).__name__, "columns": columns,
+                   "input": input_hash, "params": params}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf8")).hexdigest()
+
+# Packs the per-row results of a precomputation into (values, offsets): rows of scalars become
+# an (n,) array, rows of equally shaped arrays an (n, ...) array, ragged rows are concatenated
+# along the first axis with offsets (n + 1,) marking where each row starts
+def pack_rows(rows):
+    rows = list(rows)
+    if len(rows) == 0 or np.ndim(rows[0]) == 0:
+        return np.asarray(rows), None
+    rows = [np.asarray(row) for row in rows]
+    if all(row.shape == rows[0].shape for row in rows):
+        return np.stack(rows), None
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    return np.concatenate(rows, axis=0), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+class StoredFeature:
+    """One precomputation in the store, memory mapped. Rows are taken by position;
+        contiguous ascending rows of fixed-size features are returned as views (no copy)."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as handle:
+            self.meta = json.load(handle)
+        self.values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        self.offsets = None
+        if os.path.exists(os.path.join(path, "offsets.npy")):
+            self.offsets = np.load(os.path.join(path, "offsets.npy"))
+
+    # Pickled (e.g. for prefetch worker processes) by path, the arrays are mapped again
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    @property
+    def ragged(self):
+        return self.offsets is not None
+
+    # Fixed-size rows (a view if the rows are contiguous)
+    def take(self, rows):
+        rows = np.asarray(rows)
+        if len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+            return np.asarray(self.values[rows[0]:rows[-1] + 1])
+        return np.asarray(self.values[rows])
+
+    # List of per-row arrays (views into the store)
+    def row_list(self, rows):
+        if not self.ragged:
+            return list(self.take(rows))
+        values = np.asarray(self.values)
+        return [values[self.offsets[row]:self.offsets[row + 1]] for row in rows]
+
+    # All rows as a column for a dataframe with the given index (arrays are views into the store)
+    def series(self, index):
+        if not self.ragged and self.values.ndim == 1:
+            return pd.Series(np.asarray(self.values), index=index)
+        return pd.Series(self.row_list(np.arange(len(self))), index=index, dtype=object)
+
+    # Left-pads ragged rows with zeros to the longest row, like DataFrameExtractor's pad_stack
+    def pad_stack(self, rows):
+        if not self.ragged:
+            return self.take(rows)
+        rows = np.asarray(rows)
+        starts, lengths = self.offsets[rows], self.offsets[rows + 1] - self.offsets[rows]
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        out = np.zeros((len(rows), width) + self.values.shape[1:], dtype=np.float64)
+        total = int(np.sum(lengths))
+        within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        out[np.repeat(np.arange(len(rows)), lengths), np.repeat(width - lengths, lengths) + within] = \
+            self.values[np.repeat(starts, lengths) + within]
+        return out
+
+class FeatureStore:
+    """Directory of precomputed DataSequence features, one entry per (precomputation, input) key.
+        Each entry holds the values as one contiguous .npy array (ragged features additionally
+        an offsets array), so a later DataSequence over the same data memory maps them instead
+        of recomputing."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, fn, key):
+        return os.path.join(self.root, "{}-{}".format(fn.new_col, key[:24]))
+
+    # Stored feature of fn over df, computed and written on the first request. Returns (feature, rows),
+    # rows being the results of fn if it was computed here: (feature, None) when read from the store,
+    # (feature, rows) when computed and stored, (None, rows) when computed but not storable (not
+    # numeric), (None, None) for precomputations that cannot be keyed (the caller computes them as before)
+    def get_or_compute(self, fn, df):
+        key = feature_key(fn, df)
+        if key is None:
+            return None, None
+        path = self.entry_path(fn, key)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            return StoredFeature(path), None
+        rows = fn(df)
+        values, offsets = pack_rows(rows)
+        if values.dtype.kind not in "biufc":
+            # only numbers are stored (strings and mixed rows would come back converted)
+            return None, rows
+        # Written to a temporary directory and renamed, so readers never see partial entries
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        np.save(os.path.join(tmp_path, "values.npy"), values)
+        if offsets is not None:
+            np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as handle:
+            json.dump({"key": key, "name": fn.new_col, "class": type(fn).__name__,
+                       "rows": len(df), "method": fn.method}, handle)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_path)
+        return StoredFeature(path), rows
@@ -15,6 +15,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 import utils_data
+from utils_data import seq_encoding
 
 outputval_names = {"doudna": "rl_mean", "andreev":"log_load", "pcr3":"log_load", "eichhorn":"log_load",
                   "ptr":"ptr", "wilhelm":"ptr"}
@@ -91,26 +92,12 @@ def predict_on_MPRA(model, data_dict, varlen = False, library = "egfp_unmod_1",
 
 """ FEATURE ENCODING """
 
-# Dictionary returning one-hot encoding of nucleotides 
-nuc_dict = {'a':[1.0,0.0,0.0,0.0],'c':[0.0,1.0,0.0,0.0],'g':[0.0,0.0,1.0,0.0], 'u':[0.0,0.0,0.0,1.0], 't':[0.0,0.0,0.0,1.0], 'n':[0.0,0.0,0.0,0.0], 'x':[1/4,1/4,1/4,1/4]}
-
 # Dictionary encoding the experiments
 experiment_dict = {"egfp_unmod_1":0, "egfp_unmod_2": 1, "mcherry_1":2, "mcherry_2":3, "ga": 4, "human":5,
                   "doudna":6}
 
 def encode_seq(seq, max_len=0, min_len=None):
-    length = len(seq)
-    if max_len > 0 and min_len is None:
-        padding_needed = max_len - length
-        seq = "N"*padding_needed + seq
-    if min_len is not None:
-        if len(seq) < min_len:
-            seq = "N"*(min_len - len(seq)) + seq
-        if len(seq) > min_len:
-            seq = seq[(len(seq) - min_len):]
-    seq = seq.lower()
-    one_hot = np.array([nuc_dict[x] for x in seq]) # get stacked on top of each other
-    return one_hot
+    return seq_encoding.one_hot_encode([seq], max_len=max_len, min_len=min_len)[0]
 
 def encode_experiment(df, col="library", n_libs=6):
     mask = np.array([experiment_dict[x] for x in df[col]])
@@ -137,7 +124,7 @@ def encode_df(df, col='utr', libcol="library", n_libs=6,
     max_len = 0
     if variable_len:
         max_len = len(max(df[col], key=len))
-    one_hot = np.stack(df[col].apply(encode_seq, max_len=max_len), axis = 0)
+    one_hot = seq_encoding.one_hot_encode(df[col], max_len=max_len)
     indicator = encode_experiment(df, col=libcol, n_libs=n_libs)
     # Output column
     rl = None
@@ -145,7 +132,7 @@ def encode_df(df, col='utr', libcol="library", n_libs=6,
         rl = np.array(df[output_col])
     tis_one_hot = None
     if tis_col is not None:
-        tis_one_hot = np.stack([encode_seq(x) for x in df[tis_col]])
+        tis_one_hot = seq_encoding.one_hot_encode(df[tis_col])
     frame = build_frame(one_hot.shape[1], one_hot.shape[0])
     kozak = build_canonical_kozak_indicator(one_hot.shape[1], one_hot.shape[0])
     # Encdoe whether it is endogenous
@@ -153,13 +140,11 @@ def encode_df(df, col='utr', libcol="library", n_libs=6,
     # Encode CDS
     cds_seq = None
     if cds_col is not None:
-        max_len = len(max(df[cds_col], key=len))
-        cds_seq = np.stack(df[cds_col].apply(encode_seq, max_len=max_len), axis = 0)
+        cds_seq = seq_encoding.one_hot_encode(df[cds_col])
     # Encode 3utr
     utr3_seq = None
     if utr3_col is not None:
-        max_len = len(max(df[utr3_col], key=len))
-        utr3_seq = np.stack(df[utr3_col].apply(encode_seq, max_len=max_len), axis = 0)
+        utr3_seq = seq_encoding.one_hot_encode(df[utr3_col])
     return {"seq":one_hot, "library":indicator, "tis":tis_one_hot, "frame":frame, "kozak":kozak, "rl":rl,
            "seqtype": seqtype, "cds_seq":cds_seq, "utr3_seq":utr3_seq}
 
@@ -2,21 +2,33 @@ import re
 import random
 random.seed(1337)
 import os
+import sys
 import pickle
 import itertools
 import functools
 import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 np.random.seed(1337)
 import pandas as pd
 import scipy.stats as stats
+from scipy import sparse
 import ahocorasick
 
 import concise
 
 from keras.utils import Sequence
 
+# Shared inference helpers live next to the kipoi model
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kipoi", "5UTR_Model"))
+import seq_encoding
+import bucketing
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from feature_store import FeatureStore, read_columns
+
 class EncodingFunction:
 
     def __init__(self, name):
@@ -27,6 +39,9 @@ class EncodingFunction:
 
 class PrecomputeFunction(EncodingFunction):
     
+    # Whether results may be kept in a FeatureStore (they must only depend on the input columns and parameters)
+    cacheable = True
+    
     def __init__(self, new_col, dims, method="stack"):
         self.new_col = new_col
         self.dims = dims
@@ -71,22 +86,111 @@ class SecondaryStructureComputer(PrecomputeFunction):
         return concise.encodeRNAStructure(seq_vec, maxlen=None, seq_align='end', W=240, L=160, U=1, tmpdir='/tmp/RNAplfold/')
     
 
+# Compiles a regex made of literal letters, [..] classes of letters and "." (alternatives with "|")
+# into per-position lookup tables over bytes, one list per alternative. Returns None for other
+# regex syntax, or if two matches could overlap (re.finditer would then skip some matches)
+def byte_pattern(pattern):
+    alternatives = []
+    for alternative in pattern.split("|"):
+        tables = []
+        for token in re.findall(r"\[[^\]]*\]|.", alternative):
+            table = np.zeros(256, dtype=bool)
+            if token == ".":
+                table[:] = True
+                table[[ord("\n"), seq_encoding.PAD_CODE]] = False
+            else:
+                bases = token[1:-1] if token.startswith("[") else token
+                if len(bases) == 0 or re.search(r"[^A-Za-z]", bases):
+                    return None
+                table[[ord(base) for base in bases]] = True
+            tables.append(table)
+        if len(tables) == 0:
+            return None
+        alternatives.append(tables)
+    for first, second in itertools.product(alternatives, repeat=2):
+        for shift in range(1, len(first)):
+            if all(np.any(first[shift + i] & second[i]) for i in range(min(len(second), len(first) - shift))):
+                return None
+    return alternatives
+
+# Left-padded byte matrix of a batch of sequences (padding is the byte PAD_CODE, which no
+# compiled pattern matches) and their lengths
+def padded_byte_matrix(seqs):
+    seqs = list(seqs)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    flat = np.frombuffer("".join(seqs).encode("latin-1", errors="replace"), dtype=np.uint8)
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    byte_mat = np.full((len(seqs), width), seq_encoding.PAD_CODE, dtype=np.uint8)
+    byte_mat[sequence_mask(lengths, width)] = flat
+    return byte_mat, lengths
+
+# Mask of the sequence (non-padding) positions of a left-padded (n, width) matrix
+def sequence_mask(lengths, width):
+    return np.arange(width) >= (width - lengths)[:, None]
+
+# (n, width) mask of the match starts of a compiled pattern in a left-padded byte matrix
+def pattern_starts(byte_mat, alternatives):
+    starts = np.zeros(byte_mat.shape, dtype=bool)
+    for tables in alternatives:
+        width = byte_mat.shape[1] - len(tables) + 1
+        if width <= 0:
+            continue
+        matched = np.ones((byte_mat.shape[0], width), dtype=bool)
+        for i, table in enumerate(tables):
+            matched &= table[byte_mat[:, i:i + width]]
+        starts[:, :width] |= matched
+    return starts
+
+# Moves a mask offset columns to the right (left for negative offsets), dropping what falls off
+def shift_mask(mask, offset):
+    shifted = np.zeros_like(mask)
+    if abs(offset) >= mask.shape[1]:
+        return shifted
+    if offset >= 0:
+        shifted[:, offset:] = mask[:, :mask.shape[1] - offset]
+    else:
+        shifted[:, :offset] = mask[:, -offset:]
+    return shifted
+
+# Per-row (unpadded) float indicators of a left-padded mask for a dataframe column
+def unpadded_rows(mask, lengths, index):
+    flat = mask[sequence_mask(lengths, mask.shape[1])].astype(np.float64)
+    return pd.Series(np.split(flat, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else [], index=index, dtype=object)
+
 # Finds a pattern in the sequece and computes a mask
 class RegexPosExtractor(PrecomputeFunction):
     
     def __init__(self, seq_col, new_col, pattern="A[TU]G", offset=1):
         self.seq_col = seq_col
         self.pattern = pattern
+        self.offset = offset
         super().__init__(new_col, dims=(1,), method="pad_stack")
         
     def find(self, seq):
-        indices = [m.start()+offset for m in re.finditer(self.pattern, seq)]
+        indices = [m.start()+self.offset for m in re.finditer(self.pattern, seq)
+                   if 0 <= m.start()+self.offset < len(seq)]
         indicator = np.zeros((len(seq)))
         indicator[indices] = 1
         return indicator
+    
+    # Left-padded boolean masks of a batch of sequences and their lengths, for patterns
+    # byte_pattern can compile
+    def mask(self, seqs):
+        byte_mat, lengths = padded_byte_matrix(seqs)
+        found = shift_mask(pattern_starts(byte_mat, byte_pattern(self.pattern)), self.offset)
+        return found & sequence_mask(lengths, found.shape[1]), lengths
+    
+    # Masks of a batch of sequences, left-padded like pad_stack
+    def matrix(self, seqs):
+        if byte_pattern(self.pattern) is None:
+            # general regex, sequence by sequence
+            return DataFrameExtractor("mask", method="pad_stack")(pd.DataFrame({"mask": [self.find(seq) for seq in seqs]}))
+        return self.mask(seqs)[0].astype(np.float64)
         
     def __call__(self, df):
-        return df[self.seq_col].apply(self.find)
+        if byte_pattern(self.pattern) is None:
+            return df[self.seq_col].apply(self.find)
+        return unpadded_rows(*self.mask(df[self.seq_col].tolist()), df.index)
 
 # Records which frames are "stopped", i.e. lead to a stop codon
 class StoppedFramesExtractor(PrecomputeFunction):
@@ -97,24 +201,85 @@ class StoppedFramesExtractor(PrecomputeFunction):
         super().__init__(new_col, dims=(1,), method="pad_stack")
         
     def find(self, seq):
-        indices = [m.start()+1 for m in re.finditer(self.pattern, seq)]
-        within_stop = set()
-        for idx in indices:
-            within_stop.add(idx)
-            while idx >= 3:
-                idx = idx - 3
-                within_stop.add(idx)
-        indicator = np.zeros((len(seq)))
-        indicator[list(within_stop)] = 1
-        return indicator
+        return self.matrix([seq])[0]
+    
+    # Left-padded boolean indicators of a batch of sequences and their lengths. A position is
+    # stopped if a stop codon (marked at its middle base) lies at or after it in the same frame,
+    # so the marks are scanned in reverse with a cumulative or, separately for each frame
+    def mask(self, seqs):
+        byte_mat, lengths = padded_byte_matrix(seqs)
+        stopped = shift_mask(pattern_starts(byte_mat, byte_pattern(self.pattern)), 1)
+        for frame in range(3):
+            stopped[:, frame::3] = np.logical_or.accumulate(stopped[:, frame::3][:, ::-1], axis=1)[:, ::-1]
+        return stopped & sequence_mask(lengths, stopped.shape[1]), lengths
+    
+    # Indicators of a batch of sequences, left-padded like pad_stack
+    def matrix(self, seqs):
+        return self.mask(seqs)[0].astype(np.float64)
         
     def __call__(self, df):
-        return df[self.seq_col].apply(self.find)
+        return unpadded_rows(*self.mask(df[self.seq_col].tolist()), df.index)
     
+# Digit of every nucleotide code in k-mer indices, which enumerate k-mers in A, C, T, G order
+# (itertools.product(["A","C","T","G"])), 255 for codes that are no base
+KMER_DIGITS = np.full(256, 255, dtype=np.uint8)
+KMER_DIGITS[[seq_encoding.A, seq_encoding.C, seq_encoding.T, seq_encoding.G]] = [0, 1, 2, 3]
+
+# All k-mers of a batch of sequences as rolling base-4 integer codes (the k-mer index).
+# Returns the codes, the row and start position of every k-mer, and the sequence lengths
+def rolling_kmer_codes(seqs, k):
+    seqs = list(seqs)
+    codes, lengths = seq_encoding.to_codes(seqs)
+    digits = KMER_DIGITS[codes]
+    offsets = np.cumsum(lengths) - lengths
+    n_kmers = np.maximum(lengths - k + 1, 0)
+    rows = np.repeat(np.arange(len(seqs)), n_kmers)
+    starts = np.repeat(offsets, n_kmers) + np.arange(int(np.sum(n_kmers))) - np.repeat(np.cumsum(n_kmers) - n_kmers, n_kmers)
+    kmers = np.zeros(len(starts), dtype=np.int64)
+    invalid = np.zeros(len(starts), dtype=bool)
+    for shift in range(k):
+        digit = digits[starts + shift]
+        invalid |= digit == 255
+        kmers = kmers*4 + digit
+    if np.any(invalid):
+        # like the k-mer dict lookup
+        first = np.argmax(invalid)
+        raise KeyError(seqs[rows[first]][starts[first] - offsets[rows[first]]:][:k])
+    return kmers, rows, starts - offsets[rows], lengths
+
+# Counts (row, column) pairs into a dense float (n_rows, n_cols) matrix or a CSR matrix,
+# optionally divided by the row sums
+def count_matrix(rows, cols, n_rows, n_cols, sparse_output=False, divide_counts=False):
+    keys = rows*n_cols + cols
+    if sparse_output:
+        keys, counts = np.unique(keys, return_counts=True)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n_cols, minlength=n_rows))])
+        counts = counts.astype(np.float64)
+        if divide_counts:
+            row_sums = np.bincount(keys // n_cols, weights=counts, minlength=n_rows)
+            counts = counts/row_sums[keys // n_cols]
+        return sparse.csr_matrix((counts, keys % n_cols, indptr), shape=(n_rows, n_cols))
+    counts = np.bincount(keys, minlength=n_rows*n_cols).reshape(n_rows, n_cols).astype(np.float64)
+    if divide_counts:
+        row_sums = counts.sum(axis=1, keepdims=True)
+        counts = np.divide(counts, row_sums, out=counts, where=row_sums > 0)
+    return counts
+
+# Per-row values of a count matrix for a dataframe column: arrays, or for CSR matrices
+# (column indices, counts, number of columns) tuples, as stacked by DataFrameExtractor's sparse_stack
+def matrix_rows(matrix, index):
+    if sparse.issparse(matrix):
+        split = matrix.indptr[1:-1]
+        rows = [(cols, counts, matrix.shape[1]) for cols, counts in
+                zip(np.split(matrix.indices, split), np.split(matrix.data, split))]
+    else:
+        rows = list(matrix)
+    return pd.Series(rows, index=index)
+
 # Extracts kmers
 class KmerExtractor(PrecomputeFunction):
     
-    def __init__(self, seq_col, new_col, k, jump=False, divide_counts=True):
+    def __init__(self, seq_col, new_col, k, jump=False, divide_counts=True, sparse=False):
         self.k = k
         self.seq_col = seq_col
         kmers = [''.join(i) for i in itertools.product(["A","C","T","G"], repeat = self.k)]
@@ -122,28 +287,29 @@ class KmerExtractor(PrecomputeFunction):
         self.kmer_dict = {kmers[k]:k for k in range(self.n)}
         self.jump = jump
         self.divide_counts = divide_counts
-        super().__init__(new_col, dims=(self.n,))
+        # CSR output, for large k
+        self.sparse = sparse
+        self.cacheable = not sparse
+        super().__init__(new_col, dims=(self.n,), method="sparse_stack" if sparse else "stack")
+    
+    # (n, 4^k) counts of a batch of sequences
+    def matrix(self, seqs):
+        kmers, rows, positions, lengths = rolling_kmer_codes(seqs, self.k)
+        if self.jump:
+            keep = positions % self.k == 0
+            kmers, rows = kmers[keep], rows[keep]
+        return count_matrix(rows, kmers, len(lengths), self.n, self.sparse, self.divide_counts)
     
     def extract(self, seq):
-        i = 0
-        arr = np.zeros(self.n)
-        while i < len(seq) - (self.k - 1):
-            arr[self.kmer_dict[seq[i:i+self.k]]] = arr[self.kmer_dict[seq[i:i+self.k]]] + 1
-            if self.jump:
-                i = i + self.k
-            else:
-                i += 1
-        if self.divide_counts:
-            arr/np.sum(arr)
-        return arr
+        return matrix_rows(self.matrix([seq]), [0])[0]
 
     def __call__(self, df):
-        return df[self.seq_col].apply(self.extract)
+        return matrix_rows(self.matrix(df[self.seq_col].tolist()), df.index)
 
 # Extracts kmers for each frame
 class FramedKmerExtractor(PrecomputeFunction):
     
-    def __init__(self, seq_col, new_col, k, jump=False, divide_counts=True):
+    def __init__(self, seq_col, new_col, k, jump=False, divide_counts=True, sparse=False):
         self.k = k
         self.seq_col = seq_col
         kmers = [''.join(i) for i in itertools.product(["A","C","T","G"], repeat = self.k)]
@@ -151,25 +317,27 @@ class FramedKmerExtractor(PrecomputeFunction):
         self.kmer_dict = {kmers[k]:k for k in range(self.n)}
         self.jump = jump
         self.divide_counts = divide_counts
-        super().__init__(new_col, dims=(self.n*3,))
+        # CSR output, for large k
+        self.sparse = sparse
+        self.cacheable = not sparse
+        super().__init__(new_col, dims=(self.n*3,), method="sparse_stack" if sparse else "stack")
+    
+    # (n, 3*4^k) counts of a batch of sequences, frame by frame. Frames are counted from the end:
+    # the i-th k-mer from the end (1-based, i = len - (k-1) - start) is in frame i % 3
+    def matrix(self, seqs):
+        kmers, rows, positions, lengths = rolling_kmer_codes(seqs, self.k)
+        from_end = lengths[rows] - (self.k - 1) - positions
+        if self.jump:
+            keep = (from_end - 1) % self.k == 0
+            kmers, rows, from_end = kmers[keep], rows[keep], from_end[keep]
+        return count_matrix(rows, (from_end % 3)*self.n + kmers, len(lengths), self.n*3,
+                            self.sparse, self.divide_counts)
     
     def extract(self, seq):
-        i = 1
-        arrays = [np.zeros(self.n), np.zeros(self.n), np.zeros(self.n)]
-        while i <= len(seq) - (self.k - 1):
-            j = len(seq) - (self.k - 1) - i
-            arrays[i % 3][self.kmer_dict[seq[j:j+self.k]]] = arrays[i % 3][self.kmer_dict[seq[j:j+self.k]]] + 1
-            if self.jump:
-                i = i + self.k
-            else:
-                i += 1
-        arr = np.concatenate(arrays)
-        if self.divide_counts:
-            arr/np.sum(arr)
-        return arr
+        return matrix_rows(self.matrix([seq]), [0])[0]
 
     def __call__(self, df):
-        return df[self.seq_col].apply(self.extract)    
+        return matrix_rows(self.matrix(df[self.seq_col].tolist()), df.index)
     
 # Extracts kmers at specific positions (e.g. start or end of sequence)
 class KmerAtPosExtractor(PrecomputeFunction):
@@ -266,6 +434,9 @@ class NodererScore(PrecomputeFunction):
 
 class PrecomputeEmbeddings(PrecomputeFunction):
     
+    # Depends on the model weights, which are not part of the store key
+    cacheable = False
+    
     def __init__(self, new_col, model, layer_name, input_layer_names,
                  generator_encoding_functions, 
                  dim_select=None,
@@ -290,12 +461,27 @@ class PrecomputeEmbeddings(PrecomputeFunction):
 
 class DataFrameExtractor(EncodingFunction):
     
-    def __init__(self, col, method="stack"):
+    # With a stored feature (see feature_store.py), rows are taken from it by the position
+    # in the df index instead of from the column
+    def __init__(self, col, method="stack", feature=None):
         self.col = col
         super().__init__(col)
         self.method = method
+        self.feature = feature
+    
+    def extract_stored(self, rows):
+        if self.method == "pad_stack":
+            return self.feature.pad_stack(rows)
+        elif self.method in ("direct", "stack"):
+            if self.feature.ragged:
+                return np.stack(self.feature.row_list(rows), axis = 0)
+            return self.feature.take(rows)
+        else:
+            return np.concatenate(self.feature.row_list(rows), axis = 0)
         
     def __call__(self, df):
+        if self.feature is not None:
+            return self.extract_stored(df.index.values)
         if self.method == "direct":
             return np.array(df[self.col])
         elif self.method == "stack":
@@ -308,6 +494,13 @@ class DataFrameExtractor(EncodingFunction):
                     vector = np.concatenate([np.zeros(max_len - len(vector)), vector])
                 col_list.append(vector)
             return np.stack(col_list, axis = 0)
+        elif self.method == "sparse_stack":
+            # rows of (column indices, counts, number of columns), see matrix_rows
+            rows = list(df[self.col])
+            indptr = np.concatenate([[0], np.cumsum([len(cols) for cols, _, _ in rows])])
+            return sparse.csr_matrix((np.concatenate([counts for _, counts, _ in rows]),
+                                      np.concatenate([cols for cols, _, _ in rows]), indptr),
+                                     shape=(len(rows), rows[0][2]))
         else:
             return np.concatenate(list(df[self.col]), axis = 0)
         
@@ -316,32 +509,67 @@ class OneHotEncoder(EncodingFunction):
     def __init__(self, col, min_len=None):
         self.col = col
         self.min_len = min_len
-        self.nuc_dict = {'a':[1.0,0.0,0.0,0.0],'c':[0.0,1.0,0.0,0.0],'g':[0.0,0.0,1.0,0.0], 
-                         'u':[0.0,0.0,0.0,1.0], 't':[0.0,0.0,0.0,1.0], 
-                         'n':[0.0,0.0,0.0,0.0], 'x':[1/4,1/4,1/4,1/4]}
         super().__init__(col)
         
-
-        
     def encode_seq(self, seq, max_len=0):
-        length = len(seq)
-        if max_len > 0 and self.min_len is None:
-            padding_needed = max_len - length
-            seq = "N"*padding_needed + seq
-        if self.min_len is not None:
-            if len(seq) < self.min_len:
-                seq = "N"*(self.min_len - len(seq)) + seq
-            if len(seq) > self.min_len:
-                seq = seq[(len(seq) - self.min_len):]
-        seq = seq.lower()
-        one_hot = np.array([self.nuc_dict[x] for x in seq]) # get stacked on top of each other
-        return one_hot
+        return seq_encoding.one_hot_encode([seq], max_len=max_len, min_len=self.min_len)[0]
     
     def __call__(self, df):
-        max_len = len(max(df[self.col], key=len))
-        return np.stack([self.encode_seq(seq, max_len) 
-                         for seq in df[self.col]], axis = 0)
+        return seq_encoding.one_hot_encode(df[self.col], min_len=self.min_len)
     
+class EncodedSequenceStore:
+    """A sequence column encoded once: all sequences as one flat uint8 array of nucleotide codes
+        (see seq_encoding) with offsets and lengths, about one byte per nucleotide.
+        Batches are gathered by row position into a left-padded code matrix, using a
+        per-thread buffer that is reused across batches."""
+
+    def __init__(self, seqs):
+        seqs = list(seqs)
+        self.codes, self.lengths = seq_encoding.to_codes(seqs)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        bad = np.where(self.codes == seq_encoding.UNKNOWN_CODE)[0]
+        if len(bad) > 0:
+            row = np.searchsorted(self.offsets, bad[0], side="right") - 1
+            raise seq_encoding.UnknownBaseError(seqs[row][bad[0] - self.offsets[row]], seqs[row])
+        self.local = threading.local()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # The buffer is per thread (prefetch workers gather concurrently) and not pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    # Left-padded (len(rows), width) code matrix of the rows, a view of the reused buffer
+    # (only valid until the next gather in the same thread)
+    def gather(self, rows, width):
+        size = len(rows)*width
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None or buffer.size < size:
+            buffer = self.local.buffer = np.empty(max(size, 1), dtype=np.uint8)
+        out = buffer[:size].reshape(len(rows), width)
+        return seq_encoding.gather_codes(self.codes, self.offsets[rows], self.lengths[rows], width, out=out)
+
+class StoredOneHotEncoder(EncodingFunction):
+    """OneHotEncoder reading from an EncodedSequenceStore of its column, by the position in the df index"""
+
+    def __init__(self, encoder, store):
+        self.col = encoder.col
+        self.min_len = encoder.min_len
+        self.store = store
+        super().__init__(encoder.name)
+
+    def __call__(self, df):
+        rows = df.index.values
+        width = seq_encoding.padded_width(self.store.lengths[rows], min_len=self.min_len)
+        return seq_encoding.one_hot_from_codes(self.store.gather(rows, width))
+
 class FrameEncoder(EncodingFunction):
     
     def __init__(self, col, min_len=None):
@@ -376,43 +604,175 @@ class LibraryEncoder(EncodingFunction):
     
 ### Dataloader ###
 
+# DataSequence copy of a prefetch worker process, set by the pool initializer
+prefetch_sequence = None
+
+def init_prefetch_worker(sequence):
+    global prefetch_sequence
+    prefetch_sequence = sequence
+
+def build_batch_in_worker(rows):
+    return prefetch_sequence.build_batch(rows)
+
 class DataSequence(Sequence):
     
     def __init__(self, df, precomputations=[], 
                  encoding_functions=[],
                  input_order=None,
                  output_encoding_fn=None,
-                 batch_size=128, shuffle=True):
+                 batch_size=128, shuffle=True,
+                 bucket_col=None, padding_budget=0.1,
+                 feature_store=None,
+                 prefetch=0, prefetch_workers=2, prefetch_processes=False,
+                 pre_encode=False):
         self.df = df.copy()
         self.df = df.reset_index(drop=True)
         self.encoding_functions = encoding_functions.copy()
         self.output_encoding_fn = output_encoding_fn
         self.indices = np.arange(len(self.df))
         self.batch_size = batch_size
+        # Precomputations are kept in the feature store (a FeatureStore or its directory), if given,
+        # and read from it by later DataSequences over the same data instead of being recomputed
+        if isinstance(feature_store, str):
+            feature_store = FeatureStore(feature_store)
+        # Stored features that other functions read (or bucketing) are still set as dataframe columns
+        read_later = {bucket_col}
+        for fn in list(precomputations) + self.encoding_functions + [output_encoding_fn]:
+            if fn is not None:
+                read_later |= read_columns(fn)
         for fn in precomputations:
-            print("Doing precomputation: " + fn.new_col)
-            self.encoding_functions.append(DataFrameExtractor(fn.new_col, fn.method))
-            self.df[fn.new_col] = fn(self.df)
+            feature, rows = None, None
+            if feature_store is not None:
+                print("Loading or doing precomputation: " + fn.new_col)
+                feature, rows = feature_store.get_or_compute(fn, self.df)
+            if feature is None and rows is None:
+                print("Doing precomputation: " + fn.new_col)
+                rows = fn(self.df)
+            if feature is None or fn.new_col in read_later:
+                self.df[fn.new_col] = rows if rows is not None else feature.series(self.df.index)
+            self.encoding_functions.append(DataFrameExtractor(fn.new_col, fn.method, feature=feature))
         if input_order is not None:
             fn_dict = {fn.name:fn for fn in self.encoding_functions}
             self.encoding_functions = [fn_dict[name] for name in input_order]
+        # With pre_encode, the columns of one-hot encoders are encoded once, batches are gathered from the codes
+        if pre_encode:
+            stores = {}
+            for i, fn in enumerate(self.encoding_functions):
+                if type(fn) is OneHotEncoder:
+                    if fn.col not in stores:
+                        stores[fn.col] = EncodedSequenceStore(self.df[fn.col])
+                    self.encoding_functions[i] = StoredOneHotEncoder(fn, stores[fn.col])
         self.shuffle = shuffle
+        # Length bucketing: batches hold sequences of similar length to save padding
+        self.bucket_col = bucket_col
+        self.padding_budget = padding_budget
+        self.batches = None
+        if self.bucket_col is not None:
+            self.lengths = self.df[self.bucket_col].str.len().values
+            self.batches = bucketing.length_buckets(self.lengths, self.batch_size, self.padding_budget)
+            print("Padding efficiency: {:.3f} (bucketed), {:.3f} (unbucketed)".format(
+                bucketing.padding_efficiency(self.lengths, self.batches),
+                bucketing.padding_efficiency(self.lengths, 
+                                             bucketing.sequential_batches(len(self.df), self.batch_size))))
+        # Background batch production: while batch idx is consumed, batches idx+1..idx+prefetch
+        # are built by a pool of prefetch_workers threads (or processes, each with a copy of the sequence)
+        self.prefetch = prefetch
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_processes = prefetch_processes
+        self.executor = None
+        self.pending = {}
+        # keras may request batches from several threads at once
+        self.prefetch_lock = threading.Lock()
         super().__init__()
 
     def __len__(self):
+        if self.batches is not None:
+            return len(self.batches)
         return int(np.ceil(len(self.df) / float(self.batch_size)))
 
-    def __getitem__(self, idx):
-        batch_df = self.df.iloc[self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]]
+    # Positions of the rows of batch idx in the (current epoch's) order
+    def batch_rows(self, idx):
+        if self.batches is not None:
+            return self.batches[idx]
+        return self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+    
+    def build_batch(self, rows):
+        batch_df = self.df.iloc[rows]
         # Feed input
         inputs = [fn(batch_df) for fn in self.encoding_functions]
         if self.output_encoding_fn is None:
             return inputs
         else:
             return (inputs, self.output_encoding_fn(batch_df))
+    
+    # Schedules building batch idx, with its rows fixed now (so results do not depend on timing)
+    def submit(self, idx):
+        if self.executor is None:
+            if self.prefetch_processes:
+                self.executor = ProcessPoolExecutor(self.prefetch_workers, initializer=init_prefetch_worker,
+                                                    initargs=(self,))
+            else:
+                self.executor = ThreadPoolExecutor(self.prefetch_workers)
+        rows = self.batch_rows(idx)
+        if self.prefetch_processes:
+            return self.executor.submit(build_batch_in_worker, rows)
+        return self.executor.submit(self.build_batch, rows)
+    
+    # Drops the prefetched batches, e.g. when the order changes
+    def clear_prefetch(self):
+        with self.prefetch_lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+    
+    # Stops the prefetch workers
+    def close(self):
+        self.clear_prefetch()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None
+        state["pending"] = {}
+        del state["prefetch_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prefetch_lock = threading.Lock()
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Batch {} out of range for {} batches".format(idx, len(self)))
+        if self.prefetch == 0:
+            return self.build_batch(self.batch_rows(idx))
+        # Batches are expected in order (as in predict_generator, or fit_generator with shuffle=False,
+        # the sequence shuffles itself); out of order requests still work, but are not prefetched.
+        # The future of batch idx is taken out of pending under the lock, so concurrent requests
+        # cannot cancel it, and waited on outside of it
+        with self.prefetch_lock:
+            for key in [key for key in self.pending if key < idx or key > idx + self.prefetch]:
+                self.pending.pop(key).cancel()
+            for ahead in range(idx, min(idx + self.prefetch + 1, len(self))):
+                if ahead not in self.pending:
+                    self.pending[ahead] = self.submit(ahead)
+            future = self.pending.pop(idx)
+        return future.result()
             
     def on_epoch_end(self):
         'Updates indices after each epoch'
+        self.clear_prefetch()
         self.indices = np.arange(len(self.df))
         if self.shuffle:
             np.random.shuffle(self.indices)
+            if self.batches is not None:
+                self.batches = bucketing.length_buckets(self.lengths, self.batch_size, self.padding_budget,
+                                                        rng=np.random)
+    
+    def restore_order(self, predictions):
+        'Puts predictions made over the (bucketed) batches back into the order of the dataframe'
+        if self.batches is None:
+            return predictions
+        return bucketing.restore_order(predictions, self.batches)
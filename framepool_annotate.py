@@ -8,36 +8,367 @@ Script to invoke FramePool annotation provided an input dataframe path
 @author: bbowles
 """
 
+import os
 import sys
+import time
 import argparse
-sys.path.append('/app/modules/')
-from kipoi_functions import framepool_caller
+import tempfile
+import importlib
+import importlib.util
+import multiprocessing
+
+MODULE_DIR = '/app/modules/'
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kipoi", "5UTR_Model")
+
+# Heavy modules, in the order they get pulled in by the annotation stack
+# (imported lazily, only once real work starts)
+HEAVY_IMPORTS = ["numpy", "pandas", "tensorflow", "keras", "kipoi", "pybedtools", "kipoi_functions"]
+
+# Imports and returns the FramePool caller
+def load_caller():
+    sys.path.append(MODULE_DIR)
+    from kipoi_functions import framepool_caller
+    return framepool_caller
+
+# Output formats and their file extensions
+OUTPUT_FORMATS = {"tsv": "tsv", "parquet": "parquet", "arrow": "arrow"}
+INPUT_EXTENSIONS = (".tsv", ".parquet")
+# Float columns containing these names are stored as float32 in columnar outputs
+FOLD_CHANGE_KEYS = ("mrl_fold_change", "shift_1", "shift_2", "fold_change")
+# Rows per parquet row group / arrow record batch when a whole table is written at once
+ROW_GROUP_ROWS = 1 << 16
+# Default rows per chunk when streaming. Every chunk pays a tsv round trip and a full
+# framepool_caller call (with its setup), so chunks are kept large
+STREAM_CHUNK_ROWS = 1 << 18
+
+# Reads a whole tsv or parquet input
+def read_input(path):
+    import pandas as pd
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep='\t')
+
+# Reads a tsv or parquet input in chunks of chunk_size rows
+def read_input_chunks(path, chunk_size):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, sep='\t', chunksize=chunk_size)
+
+class ResultWriter:
+    """Writes annotated rows to a tsv, parquet or arrow (IPC file) output, one chunk at a time.
+        In the columnar formats fold change columns are stored as float32 and string (metadata)
+        columns are dictionary encoded with int32 indices. The column types are fixed from the
+        first chunk and every later chunk is converted to them. Every written chunk becomes its own
+        parquet row group / arrow record batch; the dictionaries only grow across chunks,
+        as the arrow file format requires."""
+
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        self.writer = None
+        self.schema = None
+        self.vocabularies = {}
+
+    # Dictionary encodes a string column against the values seen in previous chunks
+    def encode_dictionary(self, name, column):
+        import numpy as np
+        import pyarrow as pa
+        vocabulary, values = self.vocabularies.setdefault(name, ({}, []))
+        missing = column.isna().values
+        column = column[~missing].astype(str)
+        for value in column.unique():
+            if value not in vocabulary:
+                vocabulary[value] = len(values)
+                values.append(value)
+        if len(values) == 0 and self.output_format == "arrow":
+            # the arrow file writer takes an empty dictionary followed by values as a (forbidden)
+            # replacement rather than a delta, so all-missing columns start with an unused entry
+            vocabulary[""] = 0
+            values.append("")
+        indices = np.zeros(len(missing), dtype=np.int32)
+        indices[~missing] = column.map(vocabulary).values
+        return pa.DictionaryArray.from_arrays(pa.array(indices, mask=missing), pa.array(values, type=pa.string()))
+
+    # Output schema from the first chunk. Columns without any value yet (read as float by pandas)
+    # are taken as strings; integer and boolean columns stay integers/booleans, which are nullable
+    # in arrow, so later chunks with missing values (read as float/object by pandas) still fit
+    def plan_schema(self, df):
+        import pandas as pd
+        import pyarrow as pa
+        fields = []
+        for name in df.columns:
+            column = df[name]
+            if column.dtype == object or isinstance(column.dtype, pd.CategoricalDtype) or \
+                    pd.api.types.is_string_dtype(column.dtype) or column.isna().all():
+                dtype = pa.dictionary(pa.int32(), pa.string())
+            elif pd.api.types.is_bool_dtype(column.dtype):
+                dtype = pa.bool_()
+            elif pd.api.types.is_integer_dtype(column.dtype):
+                dtype = pa.int64()
+            elif column.dtype.kind == "f" and any(key in str(name) for key in FOLD_CHANGE_KEYS):
+                dtype = pa.float32()
+            else:
+                dtype = pa.array(column.values, from_pandas=True).type
+            fields.append(pa.field(str(name), dtype))
+        return pa.schema(fields)
+
+    def to_arrow(self, df):
+        import pyarrow as pa
+        if self.schema is None:
+            self.schema = self.plan_schema(df)
+        if [str(name) for name in df.columns] != self.schema.names:
+            raise ValueError("Columns of the chunk {} differ from the first chunk {}".format(
+                list(df.columns), self.schema.names))
+        columns = []
+        for name, field in zip(df.columns, self.schema):
+            if pa.types.is_dictionary(field.type):
+                columns.append(self.encode_dictionary(name, df[name]))
+            else:
+                columns.append(pa.array(df[name], type=field.type, from_pandas=True))
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def write(self, df, max_rows=ROW_GROUP_ROWS):
+        if self.output_format == "tsv":
+            header = self.writer is None
+            if header:
+                self.writer = open(self.path, "w")
+            df.to_csv(self.writer, index=False, sep='\t', header=header)
+            self.writer.flush()
+            return
+        import pyarrow as pa
+        table = self.to_arrow(df)
+        if self.writer is None:
+            if self.output_format == "parquet":
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                self.writer = pa.ipc.new_file(self.path, self.schema, options=options)
+        if self.output_format == "parquet":
+            self.writer.write_table(table, row_group_size=max_rows)
+        else:
+            self.writer.write_table(table, max_chunksize=max_rows)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        elif self.output_format == "tsv":
+            # no rows at all, still leave an (empty) output
+            open(self.path, "w").close()
+
+    # Closes and removes a partially written output (after a failure)
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Environment variables capping the thread pools of the BLAS/OpenMP libraries
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS"]
+
+# Limits the threads of this process, must run before numpy/tensorflow are imported
+def limit_threads(threads):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    if hasattr(tf, "ConfigProto"):
+        # tensorflow 1.x (keras 2.2): thread limits are set on the session
+        from keras import backend as K
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+        K.set_session(tf.Session(config=config))
+    else:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+# FramePool caller of a worker process, imported once by init_worker
+worker_caller = None
+
+# Limits the threads of a worker process and imports the FramePool caller once
+# for all the shards the worker annotates
+def init_worker(threads):
+    global worker_caller
+    limit_threads(threads)
+    worker_caller = load_caller()
+
+# Runs FramePool on one shard file inside a worker process. framepool_caller only takes a tsv
+# path, so every shard goes through a file and whatever setup the caller does per call is repeated
+# per shard (each worker gets one shard per input, or per chunk when streaming)
+def annotate_shard(shard_path):
+    return worker_caller(shard_path)
+
+# Pool of worker processes with limited threads
+def worker_pool(workers, threads_per_worker):
+    # spawn, so that workers do not inherit a forked tensorflow runtime
+    context = multiprocessing.get_context("spawn")
+    return context.Pool(workers, initializer=init_worker, initargs=(threads_per_worker,))
+
+# Splits a dataframe into row shards, annotates them in the worker pool
+# and returns the results merged in the original row order
+def annotate_shards(df, pool, workers, tmp_dir):
+    import numpy as np
+    import pandas as pd
+    shards = [rows for rows in np.array_split(np.arange(len(df)), workers) if len(rows) > 0]
+    shard_paths = []
+    for i, rows in enumerate(shards):
+        shard_path = os.path.join(tmp_dir, "shard_{}.tsv".format(i))
+        df.iloc[rows].to_csv(shard_path, index=False, sep='\t')
+        shard_paths.append(shard_path)
+    return pd.concat(pool.map(annotate_shard, shard_paths, chunksize=1), ignore_index=True)
+
+def annotate_sharded(path, workers, threads_per_worker):
+    df = read_input(path)
+    with tempfile.TemporaryDirectory(prefix="framepool_shards_") as tmp_dir, \
+            worker_pool(workers, threads_per_worker) as pool:
+        return annotate_shards(df, pool, workers, tmp_dir)
+
+# Runs FramePool on a dataframe in this process (the caller reads its input from a tsv file)
+def annotate_frame(df, caller, tmp_dir):
+    frame_path = os.path.join(tmp_dir, "chunk.tsv")
+    df.to_csv(frame_path, index=False, sep='\t')
+    return caller(frame_path)
+
+# Reads the input in chunks of chunk_size rows, annotates each chunk (sharded over the workers
+# if workers > 1) and appends it to the output, so memory is bounded by the chunk size.
+# The caller is imported once, but framepool_caller only scores tsv files: each chunk (and each
+# shard of it) is written to a temporary tsv and scored by its own framepool_caller call, so
+# whatever setup the caller does per call is repeated per chunk. Small chunks are slow
+def annotate_streaming(path, writer, chunk_size, workers, threads_per_worker):
+    caller = load_caller() if workers == 1 else None
+    pool = worker_pool(workers, threads_per_worker) if workers > 1 else None
+    n_rows = 0
+    start = time.perf_counter()
+    try:
+        with tempfile.TemporaryDirectory(prefix="framepool_chunks_") as tmp_dir:
+            for i, chunk in enumerate(read_input_chunks(path, chunk_size)):
+                if pool is not None:
+                    scored_chunk = annotate_shards(chunk, pool, workers, tmp_dir)
+                else:
+                    scored_chunk = annotate_frame(chunk, caller, tmp_dir)
+                # one row group / record batch per chunk
+                writer.write(scored_chunk, max_rows=max(len(scored_chunk), 1))
+                n_rows += len(chunk)
+                elapsed = time.perf_counter() - start
+                print("Chunk {}: {} rows annotated in {:.1f}s ({:.1f} rows/s)".format(
+                    i + 1, n_rows, elapsed, n_rows/elapsed), file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+# Times every heavy import and a model load, reporting to stderr
+def profile_startup():
+    sys.path.append(MODULE_DIR)
+    timings = []
+    for name in HEAVY_IMPORTS:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+            timings.append((name, time.perf_counter() - start, ""))
+        except ImportError as e:
+            timings.append((name, time.perf_counter() - start, "failed: {}".format(e)))
+    # Model load (the bundled kipoi model, if present next to this script)
+    weights = os.path.join(MODEL_DIR, "model", "Framepool_combined_residual.h5")
+    if os.path.exists(weights):
+        sys.path.append(MODEL_DIR)
+        start = time.perf_counter()
+        try:
+            from model import UTRVariantEffectModel
+            UTRVariantEffectModel(weights)
+            timings.append(("model load", time.perf_counter() - start, ""))
+        except Exception as e:
+            timings.append(("model load", time.perf_counter() - start, "failed: {}".format(e)))
+    else:
+        timings.append(("model load", 0.0, "skipped: {} not found".format(weights)))
+    print("Startup profile:", file=sys.stderr)
+    for name, elapsed, note in timings:
+        print("  {:16s} {:8.3f}s {}".format(name, elapsed, note), file=sys.stderr)
+    print("  {:16s} {:8.3f}s".format("total", sum(t[1] for t in timings)), file=sys.stderr)
 
 def main():
     # Create an argument parser
     parser = argparse.ArgumentParser(description="Annotate an ORFA file with FramePool ribosome load prediction.")
 
     # Add the "--input" argument
-    parser.add_argument("--input", help="Input, tab-delimited ORFA file.", required=True)
+    parser.add_argument("--input", help="Input ORFA file, tab-delimited (.tsv) or parquet (.parquet).")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report time spent per heavy import and model load (to stderr).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, each annotating one shard of the input rows.")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="TensorFlow/BLAS threads per worker (default: cores / workers).")
+    parser.add_argument("--chunk-size", type=int, nargs="?", const=STREAM_CHUNK_ROWS, default=None,
+                        help="Stream the input in chunks of this many rows (default {} if given without a value), "
+                             "appending to the output as they are scored. Every chunk is a separate FramePool "
+                             "call through a temporary tsv, so small chunks are slow.".format(STREAM_CHUNK_ROWS))
+    parser.add_argument("--output-format", default="tsv", choices=list(OUTPUT_FORMATS),
+                        help="Output format: tab-delimited text, parquet or arrow (IPC file).")
 
     # Parse the command line arguments
     args = parser.parse_args()
 
+    # Validate before paying for any heavy import
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    needs_pyarrow = args.output_format != "tsv" or (args.input or "").endswith(".parquet")
+    if needs_pyarrow and importlib.util.find_spec("pyarrow") is None:
+        parser.error("parquet/arrow input or output needs pyarrow (pip install pyarrow)")
+    threads_per_worker = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    if args.input is None:
+        if args.profile_startup:
+            profile_startup()
+            return
+        parser.error("the following arguments are required: --input")
+
     # Get and print the full path
     path = args.input
 
-    if path.endswith(".tsv"):
+    if path.endswith(INPUT_EXTENSIONS):
+
+        if not os.path.exists(path):
+            parser.error("input file {} does not exist".format(path))
+
+        if args.profile_startup:
+            profile_startup()
+
+        outpath = os.path.splitext(path)[0] + ".framepool." + OUTPUT_FORMATS[args.output_format]
+        writer = ResultWriter(outpath, args.output_format)
 
         # run FramePool
-        scored_df = framepool_caller(path)
+        try:
+            if args.chunk_size is not None:
+                annotate_streaming(path, writer, args.chunk_size, args.workers, threads_per_worker)
+            else:
+                if args.workers > 1:
+                    scored_df = annotate_sharded(path, args.workers, threads_per_worker)
+                elif path.endswith(".parquet"):
+                    with tempfile.TemporaryDirectory(prefix="framepool_chunks_") as tmp_dir:
+                        scored_df = annotate_frame(read_input(path), load_caller(), tmp_dir)
+                else:
+                    scored_df = load_caller()(path)
 
-        # save output
-        outpath = path.replace(".tsv",".framepool.tsv")
-        scored_df.to_csv(outpath, index=False, sep='\t')
+                # save output
+                writer.write(scored_df)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.close()
         print(f"Saved FramePool-annotated output to {outpath}.")
 
     else:
-        raise Exception("Input file must end with .tsv!")
+        raise Exception("Input file must end with .tsv or .parquet!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load-test client for framepool_server.py.
+
+Sends concurrent /predict requests of random 5'UTR (ref, alt) pairs from --concurrency
+client threads and reports p50/p99 request latency and throughput.
+
+Usage: python framepool_loadtest.py [--url http://127.0.0.1:8090] [--requests 1000] [--concurrency 16]
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+
+# Random utr and a single substitution of it
+def random_pair(rng, min_len, max_len):
+    ref = "".join(rng.choice("ACGT") for _ in range(rng.randint(min_len, max_len)))
+    pos = rng.randrange(len(ref))
+    alt = ref[:pos] + rng.choice([b for b in "ACGT" if b != ref[pos]]) + ref[pos+1:]
+    return ref, alt
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(round(q/100*(len(values) - 1))), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test a running FramePool server.")
+    parser.add_argument("--url", default="http://127.0.0.1:8090")
+    parser.add_argument("--requests", type=int, default=1000, help="Total number of requests.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of client threads.")
+    parser.add_argument("--pairs-per-request", type=int, default=4)
+    parser.add_argument("--min-len", type=int, default=20)
+    parser.add_argument("--max-len", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bodies = []
+    for _ in range(args.requests):
+        pairs = [random_pair(rng, args.min_len, args.max_len) for _ in range(args.pairs_per_request)]
+        bodies.append(json.dumps({"ref": [p[0] for p in pairs], "alt": [p[1] for p in pairs]}).encode("utf8"))
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    next_request = iter(range(args.requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(next_request, None)
+            if i is None:
+                return
+            request = urllib.request.Request(args.url + "/predict", data=bodies[i],
+                                             headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    print("requests: {} ok, {} failed in {:.2f}s".format(len(latencies), len(errors), wall))
+    if latencies:
+        print("latency p50 {:.1f} ms, p99 {:.1f} ms".format(percentile(latencies, 50)*1000,
+                                                          percentile(latencies, 99)*1000))
+        print("throughput {:.1f} requests/s, {:.1f} pairs/s".format(
+            len(latencies)/wall, len(latencies)*args.pairs_per_request/wall))
+    with urllib.request.urlopen(args.url + "/health") as response:
+        print("server:", response.read().decode("utf8"))
+    if errors:
+        print("first error:", errors[0])
+
+if __name__ == "__main__":
+    main()
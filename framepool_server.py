@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running FramePool inference server.
+
+Keeps a UTRVariantEffectModel loaded and merges concurrent client requests into
+micro-batches (bounded by --max-batch-size pairs and --max-latency-ms of waiting).
+
+POST /predict with a JSON body {"ref": [seq, ...], "alt": [seq, ...]} returns
+{"mrl_fold_change": [...], "shift_1": [...], "shift_2": [...]} (log2 fold changes, one per pair).
+GET /health returns batching statistics.
+
+Usage: python framepool_server.py [--port 8090] [--backend keras|numpy]
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kipoi", "5UTR_Model")
+OUTPUTS = ["mrl_fold_change", "shift_1", "shift_2"]
+
+class PendingRequest:
+    """One client request waiting in the batch queue"""
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """Collects (ref, alt) pairs from concurrent requests and runs them through the model together.
+        A batch is sent once it holds max_batch_size pairs or the oldest request has waited
+        max_latency seconds, whichever comes first. Requests are never split across batches."""
+
+    def __init__(self, model, max_batch_size=256, max_latency=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.stats = {"requests": 0, "pairs": 0, "batches": 0}
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # Queues the pairs and blocks until they are scored
+    def predict(self, pairs):
+        request = PendingRequest(pairs)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    # Takes requests off the queue until the batch is full or the deadline passes
+    def collect(self):
+        batch = [self.queue.get()]
+        n_pairs = len(batch[0].pairs)
+        deadline = time.perf_counter() + self.max_latency
+        while n_pairs < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_pairs += len(request.pairs)
+        return batch
+
+    def score(self, requests):
+        pairs = np.array([pair for request in requests for pair in request.pairs], dtype=object)
+        preds = self.model.predict_on_batch(pairs)
+        start = 0
+        for request in requests:
+            stop = start + len(request.pairs)
+            request.result = {key: preds[key][start:stop].tolist() for key in OUTPUTS}
+            start = stop
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.score(batch)
+            except Exception:
+                # A bad request (e.g. an unknown base) should only fail itself
+                for request in batch:
+                    try:
+                        self.score([request])
+                    except Exception as e:
+                        request.error = e
+            self.stats["requests"] += len(batch)
+            self.stats["pairs"] += sum(len(request.pairs) for request in batch)
+            self.stats["batches"] += 1
+            for request in batch:
+                request.done.set()
+
+class FramepoolServer(ThreadingHTTPServer):
+    # The default listen backlog (5) resets connections under concurrent load
+    request_queue_size = 128
+    daemon_threads = True
+
+class PredictionHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        stats = dict(self.server.batcher.stats)
+        stats["mean_batch_pairs"] = stats["pairs"]/max(stats["batches"], 1)
+        self.send_json(200, stats)
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if len(body["ref"]) != len(body["alt"]):
+                raise ValueError("ref and alt must have the same length")
+            pairs = list(zip(body["ref"], body["alt"]))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "bad request: {}".format(e)})
+            return
+        if len(pairs) == 0:
+            self.send_json(200, {key: [] for key in OUTPUTS})
+            return
+        try:
+            self.send_json(200, self.server.batcher.predict(pairs))
+        except Exception as e:
+            self.send_json(422, {"error": str(e)})
+
+    # Request logging would dominate at high request rates
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve FramePool variant effect predictions over HTTP.")
+    parser.add_argument("--weights", default=os.path.join(MODEL_DIR, "model", "Framepool_combined_residual.h5"))
+    parser.add_argument("--backend", default="keras", choices=["keras", "numpy"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--max-batch-size", type=int, default=256, help="Max (ref, alt) pairs per model call.")
+    parser.add_argument("--max-latency-ms", type=float, default=10.0,
+                        help="Max time the oldest request waits for the batch to fill.")
+    args = parser.parse_args()
+
+    sys.path.append(MODEL_DIR)
+    from model import UTRVariantEffectModel
+    model = UTRVariantEffectModel(args.weights, backend=args.backend)
+    # Predict once on this thread, so that keras builds its predict function (in the graph of
+    # the loaded model) before the batcher thread uses it, and the first request does not pay for it
+    model.predict_on_batch(np.array([["ACGTACGTAAAT", "ACGTACCTAAAT"]]))
+
+    server = FramepoolServer((args.host, args.port), PredictionHandler)
+    server.batcher = MicroBatcher(model, max_batch_size=args.max_batch_size,
+                                  max_latency=args.max_latency_ms/1000)
+    print("Serving FramePool predictions on http://{}:{}/predict".format(args.host, args.port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import numpy as np
+
+# Groups sequence indices into batches of similar length.
+# Sequences are sorted by length and a batch is closed once it holds batch_size sequences,
+# or once adding the next (longer) sequence would push the fraction of padded positions
+# in the batch above padding_budget. If an rng is given, sequences of equal length and
+# the order of the batches are shuffled.
+def length_buckets(lengths, batch_size=128, padding_budget=0.1, rng=None):
+    lengths = np.asarray(lengths)
+    if rng is None:
+        order = np.argsort(lengths, kind="stable")
+    else:
+        perm = rng.permutation(len(lengths))
+        order = perm[np.argsort(lengths[perm], kind="stable")]
+    batches = []
+    start = 0
+    real = 0
+    for i, length in enumerate(lengths[order]):
+        n = i - start
+        if n > 0:
+            padded = (n + 1) * length
+            if n == batch_size or (padded > 0 and 1 - (real + length)/padded > padding_budget):
+                batches.append(order[start:i])
+                start, real = i, 0
+        real += length
+    if start < len(order):
+        batches.append(order[start:])
+    if rng is not None:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+# Splits indices into consecutive batches (i.e. the unbucketed batching)
+def sequential_batches(n, batch_size=128):
+    return [np.arange(i, min(i + batch_size, n)) for i in range(0, n, batch_size)]
+
+# Fraction of positions in the padded batches that hold actual sequence
+def padding_efficiency(lengths, batches):
+    lengths = np.asarray(lengths)
+    real = sum(int(np.sum(lengths[batch])) for batch in batches)
+    padded = sum(len(batch) * int(np.max(lengths[batch])) for batch in batches if len(batch) > 0)
+    if padded == 0:
+        return 1.0
+    return real / padded
+
+# Puts outputs computed batch by batch back into the original order of the sequences
+def restore_order(outputs, batches):
+    order = np.concatenate(batches)
+    outputs = np.asarray(outputs)
+    restored = np.empty_like(outputs)
+    restored[order] = outputs
+    return restored
@@ -1,6 +1,10 @@
 import os
+import sys
+import queue
 import tempfile
+import traceback
 import subprocess
+import multiprocessing
 
 import pandas as pd
 import numpy as np
@@ -8,6 +12,7 @@ import numpy as np
 from kipoi.metadata import GenomicRanges
 from kipoi.data import Dataset
 
+from kipoiseq.dataclasses import Variant
 from kipoiseq.extractors import FastaStringExtractor
 from kipoiseq.extractors import MultiSampleVCF, VariantSeqExtractor, SingleSeqVCFSeqExtractor
 from kipoiseq.dataloaders.sequence import BedDataset
@@ -17,6 +22,33 @@ from kipoiseq.utils import to_scalar
 import pybedtools
 from pybedtools import BedTool, Interval
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import interval_index
+import seq_encoding
+from reference_store import ReferenceStore, variant_tuple
+
+# Stacks dataloader items into one batch (inputs (n, 2), metadata as arrays)
+def collate_items(items):
+    return {"inputs": np.stack([item["inputs"] for item in items]),
+            "metadata": {key: np.array([item["metadata"][key] for item in items])
+                         for key in items[0]["metadata"]}}
+
+# The variant_to_dict STR of a kipoiseq Variant or cyvcf2-style record
+def variant_string(variant):
+    if hasattr(variant, "pos"):
+        return "%s:%s:%s:['%s']" % (variant.chrom, variant.pos, variant.ref, variant.alt)
+    return "%s:%s:%s:['%s']" % (variant.CHROM, variant.POS, variant.REF, variant.ALT[0])
+
+# Worker process of StrandedSequenceVariantDataloader.iter_parallel: extracts the given
+# transcripts (in order) with its own file handles and puts lists of items into the queue
+def extract_partition(dataset, indices, out_queue, batch_size):
+    try:
+        dataset.close_handles()
+        for start in range(0, len(indices), batch_size):
+            out_queue.put([dataset[idx] for idx in indices[start:start+batch_size]])
+    except Exception:
+        out_queue.put(traceback.format_exc())
+
 class StrandedSequenceVariantDataloader(Dataset):
     """Dataloader for a combination of fasta, bgzip compressed vcf and bed3+ input files, 
         where a specific user-specified column (>3, 1-based) of the bed denotes the strand
@@ -34,6 +66,15 @@ class StrandedSequenceVariantDataloader(Dataset):
         It then joins intervals belonging to the same transcript, as specified by the id, to a single utr.
         For these utr, it extracts the reference sequence from the fasta file, 
         injects the applicable variants and reverse complements according to the strand information.
+        If a reference_store (see reference_store.py) is given, the reference sequences of the stored
+        transcripts are read from it instead of the fasta.
+        With per_variant=True, there is one item per (utr, overlapping variant) instead of one per utr,
+        with only that variant injected and its string representation (variant_to_dict STR) as the
+        variants metadata. Items of a utr are consecutive and share its reference sequence, which is
+        extracted once (and, since it is identical, predicted once by the model's reference cache).
+        With stream_vcf=True, the vcf (plain or bgzipped, no tabix index needed) is instead read once
+        in a single sorted pass and merged against the bed, checking the order (chromosomes in the
+        chr_order_file order, if given).
         Returns the reference sequence and variant sequence as 
         np.array([reference_sequence, variant_sequence]). 
         Region metadata is additionally provided"""
@@ -45,7 +86,10 @@ class StrandedSequenceVariantDataloader(Dataset):
                  chr_order_file=None,
                  strand_column=6,
                  id_column=4,
-                 num_chr=True
+                 num_chr=True,
+                 reference_store=None,
+                 per_variant=False,
+                 stream_vcf=False
                 ):
 
         # workaround for test
@@ -57,6 +101,11 @@ class StrandedSequenceVariantDataloader(Dataset):
         self.fasta_file = fasta_file
         self.vcf_file = vcf_file
         self.chr_order_file = chr_order_file
+        # Optional precompiled utr store (reference_store.py), replaces fasta extraction
+        self.reference_store = reference_store
+        self.per_variant = per_variant
+        # Single pass over the vcf instead of one tabix query per exon
+        self.stream_vcf = stream_vcf
        
         self.strand_column = strand_column - 1
         self.id_column = id_column - 1
@@ -70,105 +119,328 @@ class StrandedSequenceVariantDataloader(Dataset):
                               label_dtype=str,
                               ignore_targets=False)
         
-        # Intersect bed and vcf using bedtools
-        # bedtools c flag: for each bed interval, counts number of vcf entries it overlaps
-        bed_tool = pybedtools.BedTool(self.intervals_file)
-        if chr_order_file is None:
-            intersect_counts = list(bed_tool.intersect(self.vcf_file, c=True, sorted=True)) 
+        # Count the vcf entries overlapping each bed interval (like bedtools intersect -c),
+        # with an in-process interval index (no bedtools binary or temp files, any input order)
+        # or while streaming through the vcf
+        utr5_bed = self.bed.df
+        if self.stream_vcf:
+            chrom_order = None
+            if self.chr_order_file is not None:
+                chrom_order = interval_index.read_chrom_order(self.chr_order_file, self.num_chr_fasta)
+            vcf_variants, exon_rows, variant_rows = interval_index.stream_vcf_overlaps(
+                self.vcf_file, utr5_bed.iloc[:,0], utr5_bed.iloc[:,1].values, utr5_bed.iloc[:,2].values,
+                self.num_chr_fasta, chrom_order)
+            intersect_counts = np.bincount(exon_rows, minlength=len(utr5_bed))
+        elif self.per_variant:
+            vcf_variants = interval_index.read_vcf_variants(self.vcf_file)
+            vcf_chroms, vcf_starts, vcf_ends = vcf_variants["chrom"].values, \
+                vcf_variants["start"].values, vcf_variants["end"].values
         else:
-            intersect_counts = list(bed_tool.intersect(self.vcf_file, c=True, sorted=True, 
-                                                      g=self.chr_order_file))
-        intersect_counts = np.array([isect.count for isect in intersect_counts])
+            vcf_chroms, vcf_starts, vcf_ends = interval_index.read_vcf_intervals(self.vcf_file)
+        if not self.stream_vcf:
+            variant_index = interval_index.IntervalIndex(
+                interval_index.normalize_chroms(vcf_chroms, self.num_chr_fasta), vcf_starts, vcf_ends)
+            intersect_counts = variant_index.count_overlaps(
+                interval_index.normalize_chroms(utr5_bed.iloc[:,0], self.num_chr_fasta),
+                utr5_bed.iloc[:,1].values, utr5_bed.iloc[:,2].values)
                 
         # Retain only those transcripts that intersect a variant
-        utr5_bed = self.bed.df
         id_col = utr5_bed.iloc[:,self.id_column]
         retain_transcripts = utr5_bed[intersect_counts > 0].iloc[:,self.id_column]
-        utr5_bed = utr5_bed[utr5_bed.iloc[:,self.id_column].isin(retain_transcripts)]
+        retained = utr5_bed.iloc[:,self.id_column].isin(retain_transcripts).values
+        utr5_bed = utr5_bed[retained]
+        if self.stream_vcf:
+            # overlapping exons are always retained, renumber them to rows of the filtered bed
+            exon_rows = (np.cumsum(retained) - 1)[exon_rows]
         
-        # Aggregate 5utr positions per transcript
-        tuples = list(zip(utr5_bed.iloc[:,1], utr5_bed.iloc[:,2]))
-        pos = [[x] for x in tuples]
-        id_chr_strand = list(zip(utr5_bed.iloc[:,self.id_column], utr5_bed.iloc[:,0],
-                          utr5_bed.iloc[:,self.strand_column]))
-        utr5_bed_posaggreg = pd.DataFrame({"pos":pos, "id_chr_strand": id_chr_strand})
-        utr5_bed_posaggreg = utr5_bed_posaggreg.groupby("id_chr_strand").agg({'pos': 'sum'})
+        # Aggregate 5utr positions per transcript (sorted by id, chr, strand; exons in bed order)
+        ids = utr5_bed.iloc[:,self.id_column].values.astype(str)
+        chroms = utr5_bed.iloc[:,0].values.astype(str)
+        strands = utr5_bed.iloc[:,self.strand_column].values.astype(str)
+        order, group_starts = interval_index.group_rows(ids, chroms, strands)
+        exons = list(zip(utr5_bed.iloc[:,1].values[order].tolist(), utr5_bed.iloc[:,2].values[order].tolist()))
+        group_ends = np.append(group_starts[1:], len(order))
+        first = order[group_starts]
         
         # Rebuild "bed"
-        utr5_bed_posaggreg["id"] = [x[0] for x in utr5_bed_posaggreg.index]
-        utr5_bed_posaggreg["chr"] = [x[1] for x in utr5_bed_posaggreg.index]
-        utr5_bed_posaggreg["strand"] = [x[2] for x in utr5_bed_posaggreg.index]
-        self.bed = utr5_bed_posaggreg.reset_index()[["id", "chr", "pos", "strand"]]
+        self.bed = pd.DataFrame({"id": ids[first], 
+                                 "chr": chroms[first],
+                                 "pos": [exons[start:end] for start, end in zip(group_starts, group_ends)],
+                                 "strand": strands[first]})
+        
+        # One record per distinct (utr, variant) overlap, utrs in bed order, variants in vcf order
+        self.records = None
+        if self.per_variant:
+            transcript_of = np.empty(len(order), dtype=np.int64)
+            transcript_of[order] = np.repeat(np.arange(len(group_starts)), group_ends - group_starts)
+            if not self.stream_vcf:
+                exon_rows, variant_rows = variant_index.overlapping(
+                    interval_index.normalize_chroms(chroms, self.num_chr_fasta),
+                    utr5_bed.iloc[:,1].values, utr5_bed.iloc[:,2].values)
+            pairs = np.unique(np.stack([transcript_of[exon_rows], variant_rows], axis=1), axis=0)
+            pairs = pairs.reshape(-1, 2)
+            variant_strings = ["%s:%s:%s:['%s']" % variant for variant in zip(
+                vcf_variants["chrom"].values[pairs[:,1]], vcf_variants["pos"].values[pairs[:,1]],
+                vcf_variants["ref"].values[pairs[:,1]], vcf_variants["alt"].values[pairs[:,1]])]
+            self.records = pd.DataFrame({"row": pairs[:,0], "variant": variant_strings})
         
+        # Streamed variants of every exon: exon k of transcript row is exon_offsets[row] + k,
+        # its variants are rows variant_rows[exon_variant_starts[exon]:exon_variant_ends[exon]]
+        if self.stream_vcf:
+            bounds = np.searchsorted(exon_rows, np.arange(len(utr5_bed) + 1))
+            self.exon_offsets = group_starts
+            self.exon_variant_starts = bounds[order]
+            self.exon_variant_ends = bounds[order + 1]
+            self.variant_rows = variant_rows
+            self.stream_variants = vcf_variants[["chrom", "pos", "ref", "alt"]]
+        
+        # (bed row, strand-corrected reference exons) of the last extracted utr
+        self.reference_cache = None
         self.fasta_extractor = None
         self.vcf = None
         self.vcf_extractor = None
+        self.store = None
         
     def __len__(self):
+        if self.per_variant:
+            return len(self.records)
         return len(self.bed)
+    
+    # File handles are opened lazily in __getitem__, and not shared with other processes
+    def close_handles(self):
+        self.fasta_extractor = None
+        self.vcf = None
+        self.vcf_extractor = None
+        self.store = None
+        self.reference_cache = None
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for handle in ["fasta_extractor", "vcf", "vcf_extractor", "store", "reference_cache"]:
+            state[handle] = None
+        return state
+    
+    # Splits the transcripts into per-worker partitions of whole chromosomes,
+    # balancing the number of transcripts per worker
+    def chromosome_partitions(self, workers):
+        chroms = self.bed["chr"].values
+        if self.per_variant:
+            chroms = chroms[self.records["row"].values]
+        unique_chroms, counts = np.unique(chroms, return_counts=True)
+        partitions = [[] for _ in range(min(workers, len(unique_chroms)))]
+        loads = np.zeros(len(partitions), dtype=np.int64)
+        for i in np.argsort(-counts, kind="stable"):
+            worker = int(np.argmin(loads))
+            partitions[worker].append(unique_chroms[i])
+            loads[worker] += counts[i]
+        return [np.where(np.isin(chroms, partition))[0] for partition in partitions]
+    
+    # Waits for the next batch of a worker, failing if the worker died without sending it
+    def next_from_worker(self, worker_queue, process, poll_interval=1.0):
+        while True:
+            try:
+                return worker_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                if not process.is_alive():
+                    return "worker exited with code {}".format(process.exitcode)
+    
+    def iter_parallel(self, workers=4, batch_size=32, queue_size=8, mp_context=None):
+        """Extracts the (ref, alt) sequences with several worker processes, one partition
+            of whole chromosomes per worker, each with its own fasta/vcf handles.
+            Workers prefetch up to queue_size batches each into bounded queues.
+            Yields collated batches of batch_size items ({"inputs": (n, 2) array,
+            "metadata": {key: array}}), in the same order and with the same metadata as __getitem__."""
+        context = multiprocessing.get_context(mp_context)
+        partitions = self.chromosome_partitions(workers)
+        owner = np.zeros(len(self), dtype=np.int64)
+        queues, processes = [], []
+        for worker, indices in enumerate(partitions):
+            owner[indices] = worker
+            queues.append(context.Queue(maxsize=queue_size))
+            processes.append(context.Process(target=extract_partition, daemon=True,
+                                             args=(self, indices, queues[-1], batch_size)))
+        for process in processes:
+            process.start()
+        # Items of every worker arrive in increasing index order, so taking the next item
+        # from the owner of each index restores the original order
+        pending = [[] for _ in partitions]
+        batch = []
+        try:
+            for idx in range(len(self)):
+                worker = owner[idx]
+                if len(pending[worker]) == 0:
+                    items = self.next_from_worker(queues[worker], processes[worker])
+                    if not isinstance(items, list):
+                        raise RuntimeError("Dataloader worker {} failed:\n{}".format(worker, items))
+                    pending[worker] = items[::-1]
+                batch.append(pending[worker].pop())
+                if len(batch) == batch_size:
+                    yield collate_items(batch)
+                    batch = []
+            if len(batch) > 0:
+                yield collate_items(batch)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
 
-    def __getitem__(self, idx):
+    def open_fasta(self):
         if self.fasta_extractor is None:
             self.fasta_extractor = FastaStringExtractor(self.fasta_file, use_strand=True,
                                                          force_upper=self.force_upper)
-        if self.vcf is None:
-            self.vcf = MultiSampleVCF(self.vcf_file)
         if self.vcf_extractor is None:
             self.vcf_extractor = VariantSeqExtractor(self.fasta_file)
+    
+    # Variants overlapping exon k of a bed entry, from the streamed vcf or a tabix query
+    def exon_variants(self, row, k, interval):
+        if not self.stream_vcf:
+            if self.vcf is None:
+                self.vcf = MultiSampleVCF(self.vcf_file)
+            return list(self.vcf.fetch_variants(interval))
+        exon = self.exon_offsets[row] + k
+        rows = self.variant_rows[self.exon_variant_starts[exon]:self.exon_variant_ends[exon]]
+        variants = self.stream_variants.iloc[rows]
+        return [Variant(chrom, int(pos), ref, alt) for chrom, pos, ref, alt in
+                zip(variants["chrom"], variants["pos"], variants["ref"], variants["alt"])]
+    
+    # Bed row and (in per_variant mode) variant string of an item
+    def record(self, idx):
+        if self.per_variant:
+            return self.records["row"].values[idx], self.records["variant"].values[idx]
+        return idx, None
+    
+    # Extracts the strand-corrected reference and variant utr of a bed row, with only_variant
+    # (a variant string) or all overlapping variants injected. Also returns the injected
+    # variants of every exon (in bed order)
+    def extract_utr(self, row, only_variant=None):
+        if self.store is None and self.reference_store is not None:
+            self.store = ReferenceStore(self.reference_store)
         
-        entry = self.bed.iloc[idx]
+        entry = self.bed.iloc[row]
         entry_id = entry["id"]
         entry_chr = entry["chr"]
         entry_pos = entry["pos"]
         entry_strand = entry["strand"]
         
+        # Transcripts missing from the store (or with other exons) are read from the fasta
+        store_row = None
+        if self.store is not None:
+            store_row = self.store.find(entry_id, entry_chr, entry_pos)
+        if store_row is None:
+            self.open_fasta()
+        cached_ref = None
+        if self.reference_cache is not None and self.reference_cache[0] == row:
+            cached_ref = self.reference_cache[1]
+        
         ref_exons = []
         var_exons = []
-        exon_pos_strings = []
-        exon_var_strings = []
-        for exon in entry_pos:
+        exon_variants = []
+        for k, exon in enumerate(entry_pos):
             # We get the interval
             interval = pybedtools.Interval(to_scalar(entry_chr), to_scalar(exon[0]), 
                                            to_scalar(exon[1]), strand=to_scalar(entry_strand))
-            exon_pos_strings.append("%s-%s" % (str(exon[0]),str(exon[1])))
 
             # We get the reference sequence
-            ref_seq = self.fasta_extractor.extract(interval)
+            if cached_ref is not None:
+                ref_seq = cached_ref[k]
+            elif store_row is None:
+                ref_seq = self.fasta_extractor.extract(interval)
+            else:
+                ref_seq = self.store.exon_sequence(store_row, k)
 
-            # We get the variants, insert them and also save them as metadata
-            variants = list(self.vcf.fetch_variants(interval))
+            # We get the variants and insert them
+            variants = self.exon_variants(row, k, interval)
+            if only_variant is not None:
+                variants = [var for var in variants if variant_string(var) == only_variant]
             if len(variants) == 0:
-                ref_exons.append(ref_seq)
-                var_exons.append(ref_seq)
-            else:
+                var_seq = ref_seq
+            elif store_row is None:
                 var_seq = self.vcf_extractor.extract(interval, variants=variants,
                     anchor=0, fixed_len=False)
-                var_string = ";".join([str(var) for var in variants])
-
-                ref_exons.append(ref_seq)
-                var_exons.append(var_seq)
-                exon_var_strings.append(var_string)
+            else:
+                var_seq = self.store.exon_variant_sequence(store_row, k, variants)
+            ref_exons.append(ref_seq)
+            var_exons.append(var_seq)
+            exon_variants.append(variants)
+        
+        self.reference_cache = (row, list(ref_exons))
         
         # Combine
         if entry_strand == "-":
             ref_exons.reverse()
             var_exons.reverse()
-        ref_seq = "".join(ref_exons)
-        var_seq = "".join(var_exons)
-        pos_string = ";".join(exon_pos_strings)
-        var_string = ";".join(exon_var_strings)
+        return "".join(ref_exons), "".join(var_exons), exon_variants
+    
+    def __getitem__(self, idx):
+        row, only_variant = self.record(idx)
+        ref_seq, var_seq, exon_variants = self.extract_utr(row, only_variant)
+        entry = self.bed.iloc[row]
+        pos_string = ";".join(["%s-%s" % (str(exon[0]),str(exon[1])) for exon in entry["pos"]])
+        if only_variant is None:
+            var_string = ";".join([";".join([str(var) for var in variants])
+                                   for variants in exon_variants if len(variants) > 0])
+        else:
+            var_string = only_variant
         
         return {
             "inputs": np.array([ref_seq, var_seq]),
             "metadata": {
-                "id": entry_id,
-                "chr": entry_chr,
+                "id": entry["id"],
+                "chr": entry["chr"],
                 "exon_positions": pos_string,
-                "strand": entry_strand,
+                "strand": entry["strand"],
                 "variants": var_string
             }
         }
     
+    def get_batch(self, indices):
+        """Extracts several items at once, as encoded arrays instead of per item dicts:
+            ref, alt: left-padded (n, width) uint8 matrices of seq_encoding codes (padding is N,
+                bases without a code are seq_encoding.UNKNOWN_CODE), with ref_lengths, alt_lengths
+            metadata: columns id, chr, strand (n,), the exons of item i as
+                exon_starts/exon_ends[exon_offsets[i]:exon_offsets[i+1]] (bed order), and its
+                injected variants as variant_pos/variant_ref/variant_alt[variant_offsets[i]:variant_offsets[i+1]]
+                (1-based vcf positions, exon by exon like the variants string of __getitem__)"""
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        rows = np.empty(len(indices), dtype=np.int64)
+        ref_seqs, var_seqs, variant_counts, variants = [], [], [], []
+        for i, idx in enumerate(indices):
+            rows[i], only_variant = self.record(idx)
+            ref_seq, var_seq, exon_variants = self.extract_utr(rows[i], only_variant)
+            ref_seqs.append(ref_seq)
+            var_seqs.append(var_seq)
+            item_variants = [variant_tuple(var) for exon in exon_variants for var in exon]
+            variant_counts.append(len(item_variants))
+            variants.extend(item_variants)
+        batch = {}
+        for name, seqs in [("ref", ref_seqs), ("alt", var_seqs)]:
+            codes, lengths = seq_encoding.to_codes(seqs)
+            batch[name] = seq_encoding.pad_codes(codes, lengths, seq_encoding.padded_width(lengths))
+            batch[name + "_lengths"] = lengths
+        entries = self.bed.iloc[rows]
+        exon_counts = np.array([len(pos) for pos in entries["pos"]], dtype=np.int64)
+        exons = np.array([exon for pos in entries["pos"] for exon in pos], dtype=np.int64).reshape(-1, 2)
+        batch["metadata"] = {
+            "id": entries["id"].values.astype(str),
+            "chr": entries["chr"].values.astype(str),
+            "strand": entries["strand"].values.astype(str),
+            "exon_offsets": np.concatenate([[0], np.cumsum(exon_counts)]).astype(np.int64),
+            "exon_starts": exons[:,0],
+            "exon_ends": exons[:,1],
+            "variant_offsets": np.concatenate([[0], np.cumsum(variant_counts)]).astype(np.int64),
+            "variant_pos": np.array([var[0] + 1 for var in variants], dtype=np.int64),
+            "variant_ref": np.array([var[1] for var in variants], dtype=object),
+            "variant_alt": np.array([var[2] for var in variants], dtype=object)
+        }
+        return batch
+    
+    # Yields get_batch batches of all items, in order
+    def iter_batches(self, batch_size=256):
+        for start in range(0, len(self), batch_size):
+            yield self.get_batch(np.arange(start, min(start + batch_size, len(self))))
+    
     def variant_to_dict(self, variant):
         return {
             "CHROM": variant.CHROM,
@@ -0,0 +1,123 @@
+import numpy as np
+
+import seq_encoding
+
+# How far the convolution stack looks to the left and to the right of a position,
+# given (kernel_size, dilation, padding) of every convolution
+def receptive_reach(conv_layers):
+    left, right = 0, 0
+    for kernel_size, dilation, padding in conv_layers:
+        span = (kernel_size - 1)*dilation
+        if padding == "causal":
+            left += span
+        else:
+            left += span // 2
+            right += span - span // 2
+    return left, right
+
+class DeltaScorer:
+    """Scores single nucleotide substitutions against a fixed reference utr.
+        A substitution only changes the convolution output within the receptive field
+        around it, so the scorer keeps the reference activations and the per-frame pooling
+        state (prefix/suffix maxima and sums) and, for every variant, recomputes only the
+        affected window and updates the global max / masked average pools.
+        Results match a full forward pass (up to float32 rounding of the average pools).
+        Requires a UTRVariantEffectModel built with shared_conv_pass=True."""
+
+    def __init__(self, variant_model, batch_size=512):
+        if variant_model.pooling_fn is None:
+            raise ValueError("DeltaScorer needs a model with frame-wise pooling only (shared_conv_pass=True)")
+        self.variant_model = variant_model
+        self.batch_size = batch_size
+        self.conv_fn = variant_model.conv_fn
+        self.n_pools = variant_model.n_pools
+        self.left, self.right = receptive_reach(variant_model.conv_layers)
+        # inputs needed to recompute every output a substitution can change
+        self.half_window = self.left + self.right
+        self.indicator = np.array([[0.0, 1.0]])
+        self.seq = None
+
+    # Computes and stores the reference activations and pooling state
+    def set_reference(self, seq):
+        self.seq = seq
+        codes, _ = seq_encoding.to_codes([seq])
+        one_hot = seq_encoding.one_hot_encode([seq])
+        self.codes = codes
+        self.length = len(seq)
+        features = self.conv_fn(one_hot)[0].astype(np.float64)
+        mask = one_hot[0].sum(axis=1).astype(np.float64)
+        self.mask = mask
+        self.features = features
+        frame = (self.length - 1 - np.arange(self.length)) % 3
+        self.frame_pos, self.prefix_max, self.suffix_max, self.cumsum, self.count = [], [], [], [], []
+        zero = np.zeros((1, features.shape[1]))
+        for k in range(3):
+            pos = np.where(frame == k)[0]
+            feat = features[pos]
+            self.frame_pos.append(pos)
+            self.prefix_max.append(np.concatenate([zero, np.maximum.accumulate(feat, axis=0)]))
+            self.suffix_max.append(np.concatenate([np.maximum.accumulate(feat[::-1], axis=0)[::-1], zero]))
+            self.cumsum.append(np.concatenate([zero, np.cumsum(feat, axis=0)]))
+            self.count.append(np.sum(mask[pos]))
+        self.ref_pred = self.variant_model.predict_shifts(one_hot, self.indicator)[0]
+        return self
+
+    # Builds the (recomputation) input windows around each substitution
+    def build_windows(self, positions, alt_codes):
+        offsets = np.arange(-self.half_window, self.half_window + 1)
+        window_pos = positions[:, np.newaxis] + offsets
+        inside = (window_pos >= 0) & (window_pos < self.length)
+        windows = np.full(window_pos.shape, seq_encoding.PAD_CODE, dtype=np.uint8)
+        windows[inside] = self.codes[window_pos[inside]]
+        windows[:, self.half_window] = alt_codes
+        return seq_encoding.one_hot_from_codes(windows)
+
+    # Pooled features for a batch of substitutions
+    def pooled_features(self, positions, alt_codes):
+        n = len(positions)
+        new_features = self.conv_fn(self.build_windows(positions, alt_codes))
+        # Outputs whose full receptive field lies in the window, i.e. every position that can change
+        out_offsets = np.arange(-self.right, self.left + 1)
+        new_features = new_features[:, self.half_window - self.right:self.half_window + self.left + 1]
+        new_features = new_features.astype(np.float64)
+        out_pos = positions[:, np.newaxis] + out_offsets
+        valid = (out_pos >= 0) & (out_pos < self.length)
+        out_frame = (self.length - 1 - out_pos) % 3
+        start = np.maximum(positions - self.right, 0)
+        stop = np.minimum(positions + self.left, self.length - 1)
+        mask_change = seq_encoding.CODE_ONE_HOT[alt_codes].sum(axis=1) - self.mask[positions]
+        pos_frame = (self.length - 1 - positions) % 3
+        maxima, averages = [], []
+        for k in range(3):
+            in_frame = (valid & (out_frame == k))[:, :, np.newaxis]
+            window_max = np.max(new_features*in_frame, axis=1)
+            window_sum = np.sum(new_features*in_frame, axis=1)
+            # pooling state of the unchanged positions of this frame
+            i0 = np.searchsorted(self.frame_pos[k], start)
+            i1 = np.searchsorted(self.frame_pos[k], stop, side="right")
+            outside_max = np.maximum(self.prefix_max[k][i0], self.suffix_max[k][i1])
+            outside_sum = self.cumsum[k][-1] - (self.cumsum[k][i1] - self.cumsum[k][i0])
+            count = self.count[k] + mask_change*(pos_frame == k)
+            maxima.append(np.maximum(outside_max, window_max))
+            averages.append((outside_sum + window_sum)/count[:, np.newaxis])
+        pooled = maxima + averages
+        return np.concatenate(pooled[:3*self.n_pools], axis=1).reshape(n, -1)
+
+    # Scores substitutions given as 0-based positions in the reference and alternative bases
+    def score_snvs(self, positions, alt_bases):
+        positions = np.asarray(positions, dtype=np.int64)
+        alt_codes, _ = seq_encoding.to_codes(alt_bases)
+        if len(alt_codes) != len(positions):
+            raise ValueError("Need exactly one alternative base per position")
+        if np.any(alt_codes == seq_encoding.UNKNOWN_CODE):
+            raise ValueError("Cant one-hot encode unkown alternative base")
+        preds = np.empty((len(positions), 3))
+        for i in range(0, len(positions), self.batch_size):
+            batch = slice(i, i + self.batch_size)
+            pooled = self.pooled_features(positions[batch], alt_codes[batch])
+            indicator = np.repeat(self.indicator, pooled.shape[0], axis=0)
+            preds[batch] = self.variant_model.predict_shifts_from_pooled(pooled, indicator)
+        fc_changes = np.log2(preds/self.ref_pred)
+        return {"mrl_fold_change":fc_changes[:,0],
+                "shift_1":fc_changes[:,1],
+                "shift_2":fc_changes[:,2]}
@@ -0,0 +1,90 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import bucketing
+from model import UTRVariantEffectModel
+
+OUTPUTS = ["mrl_fold_change", "shift_1", "shift_2"]
+
+# Number of inputs of the network behind a UTRVariantEffectModel
+def n_inputs(variant_model):
+    if variant_model.backend == "numpy":
+        return 1 if variant_model.model.scaling is None else 2
+    return len(variant_model.model.inputs)
+
+class EnsembleVariantEffectModel:
+    """Scores variants with several Framepool models at once.
+        Every batch of (ref, alt) utrs is bucketed and one-hot encoded once, and all models
+        run on the shared tensors (in parallel when threads > 1; keras/tensorflow and numpy
+        both release the GIL inside their kernels).
+        predict_on_batch returns one table with the fold changes of every model
+        ({name}_mrl_fold_change, ...) and their mean and sd (mean_mrl_fold_change, sd_mrl_fold_change, ...).
+        Models with other inputs (the uORF models need a uORF mask, the fixed length
+        models have no experiment input) are not supported."""
+
+    def __init__(self, weights, names=None, threads=1, padding_budget=0.1, **model_kwargs):
+        if names is None:
+            names = [os.path.splitext(os.path.basename(path))[0] for path in weights]
+        if len(names) != len(weights) or len(set(names)) != len(names):
+            raise ValueError("Need one unique name per weight file")
+        self.names = names
+        self.padding_budget = padding_budget
+        # predictions are combined here, the per model reference caches are not needed
+        model_kwargs["cache_bytes"] = 0
+        self.models = [UTRVariantEffectModel(path, padding_budget=padding_budget, **model_kwargs)
+                       for path in weights]
+        for name, member in zip(names, self.models):
+            if n_inputs(member) != 2:
+                raise ValueError("Model {} has {} inputs, only (sequence, experiment) models can be ensembled"
+                                 .format(name, n_inputs(member)))
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        # Predict once serially, so that keras builds its predict functions before threads use them
+        self.predict_on_batch(np.array([["ACGTACGTAAAT", "ACGTACCTAAAT"]]))
+
+    # Runs every model on one shared one-hot tensor, returns a list of (n, 3) predictions
+    def predict_members(self, one_hot, indicator):
+        predict = lambda member: member.predict_shifts(one_hot, indicator)
+        if self.executor is None:
+            return [predict(member) for member in self.models]
+        return list(self.executor.map(predict, self.models))
+
+    # Predicts shifts of all models for ref and alt sequences, bucketed by length and encoded once
+    def predict_shifts(self, seqs):
+        preds = np.empty((len(self.models), len(seqs), 3))
+        lengths = np.array([len(seq) for seq in seqs])
+        if self.padding_budget is None:
+            batches = [np.arange(len(seqs))]
+        else:
+            batches = bucketing.length_buckets(lengths, batch_size=len(seqs), padding_budget=self.padding_budget)
+        for batch in batches:
+            one_hot = self.models[0].encode(seqs[batch])
+            indicator = np.zeros((len(batch), 2))
+            indicator[:,1] = 1
+            for i, member_preds in enumerate(self.predict_members(one_hot, indicator)):
+                preds[i, batch] = member_preds
+        return preds
+
+    # Predicts for a batch of (ref, alt) pairs, returns a DataFrame with one row per pair
+    def predict_on_batch(self, inputs):
+        if inputs.shape == (2,):
+            inputs = inputs[np.newaxis, :]
+        n = inputs.shape[0]
+        preds = self.predict_shifts(np.concatenate([inputs[:,0], inputs[:,1]]))
+        fc_changes = np.log2(preds[:, n:]/preds[:, :n])
+        table = {}
+        for name, member_fc in zip(self.names, fc_changes):
+            for j, output in enumerate(OUTPUTS):
+                table[name + "_" + output] = member_fc[:, j]
+        for j, output in enumerate(OUTPUTS):
+            table["mean_" + output] = np.mean(fc_changes[:, :, j], axis=0)
+            table["sd_" + output] = np.std(fc_changes[:, :, j], axis=0, ddof=1) if len(self.models) > 1 \
+                else np.zeros(n)
+        return pd.DataFrame(table)
+
+    # Predicts for any number of (ref, alt) pairs in batches
+    def predict(self, inputs, batch_size=256):
+        return pd.concat([self.predict_on_batch(inputs[i:i+batch_size])
+                          for i in range(0, len(inputs), batch_size)], ignore_index=True)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+# Normalizes chromosome names to the num_chr convention of the dataloader
+# (numeric: no chr prefix, otherwise with chr prefix)
+def normalize_chroms(chroms, num_chr):
+    chroms = pd.Series(chroms, dtype=str)
+    if num_chr:
+        return chroms.str.replace("^chr", "", regex=True).values
+    return np.where(chroms.str.startswith("chr"), chroms, "chr" + chroms)
+
+# Reads the variant positions of a (plain or bgzipped) vcf as 0-based half-open intervals
+# covering the reference allele, like bedtools does
+def read_vcf_intervals(vcf_file):
+    vcf = pd.read_csv(vcf_file, sep="\t", comment="#", header=None, usecols=[0, 1, 3],
+                      names=["chrom", "pos", "ref"], dtype={"chrom": str, "pos": np.int64, "ref": str})
+    starts = vcf["pos"].values - 1
+    return vcf["chrom"].values, starts, starts + vcf["ref"].str.len().values
+
+# Reads the variants of a (plain or bgzipped) vcf, one row per alternative allele (like
+# MultiSampleVCF.fetch_variants), with the 0-based half-open interval of the reference allele
+def read_vcf_variants(vcf_file):
+    vcf = pd.read_csv(vcf_file, sep="\t", comment="#", header=None, usecols=[0, 1, 3, 4],
+                      names=["chrom", "pos", "ref", "alt"],
+                      dtype={"chrom": str, "pos": np.int64, "ref": str, "alt": str})
+    vcf["alt"] = vcf["alt"].str.split(",")
+    vcf = vcf.explode("alt", ignore_index=True)
+    vcf["start"] = vcf["pos"].values - 1
+    vcf["end"] = vcf["start"].values + vcf["ref"].str.len().values
+    return vcf
+
+# Chromosome names of a genome/faidx style file (first column), in file order
+def read_chrom_order(chr_order_file, num_chr):
+    order = pd.read_csv(chr_order_file, sep="\t", header=None, usecols=[0], dtype=str).iloc[:,0]
+    return list(normalize_chroms(order, num_chr))
+
+# Concatenation of the integer ranges [start, start + count)
+def expand_ranges(starts, counts):
+    return np.repeat(starts, counts) + np.arange(int(np.sum(counts))) - np.repeat(np.cumsum(counts) - counts, counts)
+
+def is_gzipped(path):
+    with open(path, "rb") as handle:
+        return handle.read(2) == b"\x1f\x8b"
+
+def stream_vcf_overlaps(vcf_file, chroms, starts, ends, num_chr, chrom_order=None, chunk_size=1 << 18):
+    """Finds the variants overlapping the given (e.g. bed exon) intervals in a single pass over a
+        sorted, plain or bgzipped vcf, without a tabix index. The vcf is read in chunks and each
+        chunk is merged against the sorted intervals of its chromosomes by binary search.
+        Checks that the vcf is sorted: chromosomes contiguous (and in chrom_order, if given),
+        positions increasing. With chrom_order, reading stops after the last interval chromosome.
+        Returns the overlapping variants (one row per alternative allele, like read_vcf_variants)
+        and the (interval index, variant index) pairs, sorted by interval then variant."""
+    chroms = normalize_chroms(chroms, num_chr)
+    interval_index = IntervalIndex(chroms, starts, ends)
+    rank = None
+    if chrom_order is not None:
+        rank = {chrom: i for i, chrom in enumerate(chrom_order)}
+        missing = set(chroms) - set(rank)
+        if missing:
+            raise ValueError("Chromosomes missing from the chromosome order: {}".format(sorted(missing)))
+        last_rank = max([rank[chrom] for chrom in chroms], default=-1)
+    reader = pd.read_csv(vcf_file, sep="\t", comment="#", header=None, usecols=[0, 1, 3, 4],
+                         names=["chrom", "pos", "ref", "alt"], chunksize=chunk_size,
+                         compression="gzip" if is_gzipped(vcf_file) else None,
+                         dtype={"chrom": str, "pos": np.int64, "ref": str, "alt": str})
+    variants, queries, hits = [], [], []
+    n_variants = 0
+    finished_chroms = set()
+    prev_chrom, prev_pos = None, -1
+    for chunk in reader:
+        chunk_chroms = normalize_chroms(chunk["chrom"], num_chr)
+        positions = chunk["pos"].values
+        # order checks, vectorized within the chunk and across the chunk border
+        new_block = np.ones(len(chunk), dtype=bool)
+        new_block[1:] = chunk_chroms[1:] != chunk_chroms[:-1]
+        new_block[0] = chunk_chroms[0] != prev_chrom
+        if np.any(np.diff(positions)[~new_block[1:]] < 0) or (not new_block[0] and positions[0] < prev_pos):
+            raise ValueError("vcf {} is not sorted by position".format(vcf_file))
+        block_chroms = list(chunk_chroms[new_block])
+        # every chromosome before the last one of the chunk is finished
+        if prev_chrom is not None:
+            finished_chroms.add(prev_chrom)
+        for chrom in block_chroms:
+            if chrom in finished_chroms:
+                raise ValueError("Chromosomes of vcf {} are not contiguous".format(vcf_file))
+            finished_chroms.add(chrom)
+        finished_chroms.discard(chunk_chroms[-1])
+        if rank is not None:
+            block_ranks = [rank.get(chrom) for chrom in block_chroms]
+            if None in block_ranks:
+                unknown = block_chroms[block_ranks.index(None)]
+                raise ValueError("vcf chromosome {} is not in the chromosome order".format(unknown))
+            prev_rank = -1 if prev_chrom is None else rank[prev_chrom]
+            if np.any(np.diff([prev_rank] + block_ranks) <= 0):
+                raise ValueError("Chromosomes of vcf {} are not in the chromosome order".format(vcf_file))
+        prev_chrom, prev_pos = chunk_chroms[-1], positions[-1]
+        # merge against the intervals
+        var_starts = positions - 1
+        var_ends = var_starts + chunk["ref"].str.len().values
+        var_rows, interval_rows = interval_index.overlapping(chunk_chroms, var_starts, var_ends)
+        if len(var_rows) > 0:
+            keep, inverse = np.unique(var_rows, return_inverse=True)
+            overlapping = chunk.iloc[keep].reset_index(drop=True)
+            overlapping["start"] = var_starts[keep]
+            overlapping["end"] = var_ends[keep]
+            # one row per alternative allele, every overlap pair is repeated for each allele
+            n_alts = overlapping["alt"].str.count(",").values + 1
+            first_allele = np.cumsum(n_alts) - n_alts
+            overlapping["alt"] = overlapping["alt"].str.split(",")
+            overlapping = overlapping.explode("alt", ignore_index=True)
+            queries.append(np.repeat(interval_rows, n_alts[inverse]))
+            hits.append(n_variants + expand_ranges(first_allele[inverse], n_alts[inverse]))
+            variants.append(overlapping)
+            n_variants += len(overlapping)
+        if rank is not None and rank[prev_chrom] > last_rank:
+            break
+    columns = ["chrom", "pos", "ref", "alt", "start", "end"]
+    variants = pd.concat(variants, ignore_index=True)[columns] if variants else pd.DataFrame(columns=columns)
+    queries = np.concatenate(queries) if queries else np.zeros(0, dtype=np.int64)
+    hits = np.concatenate(hits) if hits else np.zeros(0, dtype=np.int64)
+    order = np.lexsort((hits, queries))
+    return variants, queries[order], hits[order]
+
+class IntervalIndex:
+    """Per-chromosome index of intervals (e.g. variants) for counting overlaps with query intervals.
+        Keeps the sorted starts and sorted ends of every chromosome, so the number of indexed intervals
+        overlapping [start, end) is #(starts < end) - #(ends <= start), two binary searches per query.
+        Neither the indexed nor the query intervals need to be sorted."""
+
+    def __init__(self, chroms, starts, ends):
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.starts = {}
+        self.ends = {}
+        # for listing overlaps: original indices and ends in start order, longest interval
+        self.start_order = {}
+        self.ends_by_start = {}
+        self.max_length = {}
+        for chrom in np.unique(chroms):
+            on_chrom = np.where(chroms == chrom)[0]
+            order = on_chrom[np.argsort(starts[on_chrom], kind="stable")]
+            self.starts[chrom] = starts[order]
+            self.ends[chrom] = np.sort(ends[on_chrom])
+            self.start_order[chrom] = order
+            self.ends_by_start[chrom] = ends[order]
+            self.max_length[chrom] = int(np.max(ends[on_chrom] - starts[on_chrom]))
+
+    # Number of indexed intervals overlapping each query interval
+    def count_overlaps(self, chroms, starts, ends):
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        counts = np.zeros(len(chroms), dtype=np.int64)
+        for chrom in np.unique(chroms):
+            if chrom not in self.starts:
+                continue
+            on_chrom = np.where(chroms == chrom)[0]
+            counts[on_chrom] = np.searchsorted(self.starts[chrom], ends[on_chrom], side="left") - \
+                               np.searchsorted(self.ends[chrom], starts[on_chrom], side="right")
+        return counts
+
+    # All overlapping (query index, indexed interval index) pairs, sorted by query then indexed interval
+    def overlapping(self, chroms, starts, ends):
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        queries, hits = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for chrom in np.unique(chroms):
+            if chrom not in self.starts:
+                continue
+            on_chrom = np.where(chroms == chrom)[0]
+            # candidates start within (start - longest interval, end)
+            lo = np.searchsorted(self.starts[chrom], starts[on_chrom] - self.max_length[chrom], side="right")
+            hi = np.searchsorted(self.starts[chrom], ends[on_chrom], side="left")
+            n = np.maximum(hi - lo, 0)
+            query = np.repeat(on_chrom, n)
+            candidate = expand_ranges(lo, n)
+            keep = self.ends_by_start[chrom][candidate] > starts[query]
+            queries.append(query[keep])
+            hits.append(self.start_order[chrom][candidate[keep]])
+        queries, hits = np.concatenate(queries), np.concatenate(hits)
+        order = np.lexsort((hits, queries))
+        return queries[order], hits[order]
+
+# Groups rows by their key columns, in the order of a pandas groupby (sorted keys,
+# original row order within a group). Returns the row order and the start of every group in it
+def group_rows(*keys):
+    # integer codes in sorted key order, much faster to sort and compare than strings
+    codes = [pd.factorize(key, sort=True)[0] for key in keys]
+    order = np.lexsort(tuple(reversed(codes)))
+    changed = np.zeros(len(order), dtype=bool)
+    if len(order) > 0:
+        changed[0] = True
+    for code in codes:
+        code = code[order]
+        changed[1:] |= code[1:] != code[:-1]
+    return order, np.where(changed)[0]
@@ -0,0 +1,23 @@
+from keras.layers import Layer
+from keras import backend as K
+import tensorflow as tf
+
+class FrameSliceLayer(Layer):
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)    
+
+    def build(self, input_shape):
+        super().build(input_shape)
+    
+    def call(self, x):
+        shape = K.shape(x)
+        x = K.reverse(x, axes=1) # reverse, so that frameness is related to fixed point
+        frame_1 = tf.gather(x, K.arange(start=0, stop=shape[1], step=3), axis=1)
+        frame_2 = tf.gather(x, K.arange(start=1, stop=shape[1], step=3), axis=1)
+        frame_3 = tf.gather(x, K.arange(start=2, stop=shape[1], step=3), axis=1)
+        return [frame_1, frame_2, frame_3]
+    
+    def compute_output_shape(self, input_shape):
+        return [(input_shape[0], None, input_shape[2]),(input_shape[0], None, input_shape[2]),
+                (input_shape[0], None, input_shape[2])]
@@ -1,87 +1,272 @@
+import os
+import sys
 from kipoi.model import BaseModel
-from keras.models import load_model
-from keras.layers import Layer
-from keras import backend as K
-import tensorflow as tf
 import numpy as np
 
-class FrameSliceLayer(Layer):
-    
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)    
-
-    def build(self, input_shape):
-        super().build(input_shape)
-    
-    def call(self, x):
-        shape = K.shape(x)
-        x = K.reverse(x, axes=1) # reverse, so that frameness is related to fixed point
-        frame_1 = tf.gather(x, K.arange(start=0, stop=shape[1], step=3), axis=1)
-        frame_2 = tf.gather(x, K.arange(start=1, stop=shape[1], step=3), axis=1)
-        frame_3 = tf.gather(x, K.arange(start=2, stop=shape[1], step=3), axis=1)
-        return [frame_1, frame_2, frame_3]
-    
-    def compute_output_shape(self, input_shape):
-        return [(input_shape[0], None, input_shape[2]),(input_shape[0], None, input_shape[2]),
-                (input_shape[0], None, input_shape[2])]
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import seq_encoding
+import bucketing
+import prediction_cache
 
 class UTRVariantEffectModel(BaseModel):
     
-        def __init__(self, weights):
-            self.nuc_dict = {'A':[1.0,0.0,0.0,0.0],'C':[0.0,1.0,0.0,0.0],'G':[0.0,0.0,1.0,0.0], 
-                             'U':[0.0,0.0,0.0,1.0], 'T':[0.0,0.0,0.0,1.0], 
-                             'N':[0.0,0.0,0.0,0.0], 'X':[1/4,1/4,1/4,1/4]}
+        def __init__(self, weights, backend="keras", shared_conv_pass=True, padding_budget=0.1,
+                     cache_bytes=64 << 20, cache_path=None, precision="float32", calibration_seqs=None):
             self.weights = weights
-            self.model = load_model(weights, custom_objects={'FrameSliceLayer': FrameSliceLayer})
+            self.backend = backend
+            if precision != "float32" and backend != "numpy":
+                raise ValueError("Reduced precision ({}) needs backend='numpy'".format(precision))
+            self.padding_budget = padding_budget
+            # Reference sequences repeat across variants of a transcript, so their predictions are cached
+            self.cache = None
+            if cache_bytes:
+                weights_hash = prediction_cache.file_hash(weights) + ":" + backend + ":" + precision
+                self.cache = prediction_cache.PredictionCache(weights_hash, max_bytes=cache_bytes, 
+                                                              store_path=cache_path)
+            self.padding_stats = {"nucleotides": 0, "padded": 0, "padded_unbucketed": 0}
+            # Heavy frameworks are only imported for the backend that is used
+            self.pooling_fn, self.head_fn = None, None
+            if backend == "numpy":
+                import numpy_engine
+                self.model = numpy_engine.NumpyFramepool(weights, precision=precision)
+                if calibration_seqs is not None:
+                    self.calibrate(calibration_seqs)
+                self.conv_layers = self.model.conv_layer_configs()
+                self.conv_fn = self.model.conv_features
+                self.n_filters, self.n_pools = self.model.n_filters, self.model.n_pools
+                if shared_conv_pass and self.model.framed and self.model.scaling is not None:
+                    self.pooling_fn, self.head_fn = self.model.pooled_features, self.model.head
+            elif backend == "keras":
+                self.load_keras_model(shared_conv_pass)
+            else:
+                raise ValueError("Unknown backend: {} (use keras or numpy)".format(backend))
+        
+        def load_keras_model(self, shared_conv_pass):
+            from keras.models import load_model, Model
+            from keras_layers import FrameSliceLayer
+            self.model = load_model(self.weights, custom_objects={'FrameSliceLayer': FrameSliceLayer})
+            self.conv_layers = [(layer.kernel_size[0], layer.dilation_rate[0], layer.padding) 
+                                for layer in self.model.layers if layer.__class__.__name__ == "Conv1D"]
+            conv_model = Model(inputs=self.model.get_layer("input_seq").input,
+                               outputs=self.model.get_layer("frame_masking").input)
+            self.conv_fn = conv_model.predict_on_batch
+            if shared_conv_pass:
+                pooling_model, head_model = self.split_at_pooling()
+                if pooling_model is not None:
+                    self.pooling_fn = pooling_model.predict_on_batch
+                    self.head_fn = lambda pooled, indicator: head_model.predict_on_batch([pooled, indicator])
+        
+        # Splits the network into the convolutions + frame-wise pooling and the dense head.
+        # Shifting the frame only changes which frame each pooled feature belongs to,
+        # so all three shifts can be predicted from a single convolution pass.
+        def split_at_pooling(self):
+            from keras.models import Model
+            from keras.layers import Input
+            layer_names = [layer.name for layer in self.model.layers]
+            pooled = self.model.get_layer("concatenate_pooled")
+            n_filters = int(self.model.get_layer("frame_masking").output_shape[0][-1])
+            pooled_dim = int(pooled.output_shape[-1])
+            if pooled_dim % (3*n_filters) != 0 or "scaling_regression" not in layer_names:
+                # extra (non frame-wise) pooled features, fall back to one pass per shift
+                return None, None
+            self.n_filters = n_filters
+            self.n_pools = pooled_dim // (3*n_filters)
+            pooling_model = Model(inputs=self.model.get_layer("input_seq").input, outputs=pooled.output)
+            # Rebuild the head on top of a pooled feature input, sharing the trained layers
+            input_pooled = Input(shape=(pooled_dim,), name="input_pooled")
+            input_experiment = Input(shape=self.model.get_layer("input_experiment").input_shape[1:], 
+                                     name="input_experiment")
+            predict = input_pooled
+            i = 0
+            while "fully_connected_"+str(i) in layer_names:
+                predict = self.model.get_layer("fully_connected_"+str(i))(predict)
+                predict = self.model.get_layer("fc_dropout_"+str(i))(predict)
+                i += 1
+            predict = self.model.get_layer("mrl_output_unscaled")(predict)
+            predict = self.model.get_layer("interaction_term")([predict, input_experiment])
+            predict = self.model.get_layer("prepare_regression")([predict, input_experiment])
+            predict = self.model.get_layer("scaling_regression")(predict)
+            head_model = Model(inputs=[input_pooled, input_experiment], outputs=predict)
+            return pooling_model, head_model
+        
+        # Calibrates the int8 activation scales of the numpy engine on sample sequences
+        # (e.g. MPRA utrs from data_dict), in length buckets
+        def calibrate(self, seqs, batch_size=128):
+            seqs = np.asarray(seqs, dtype=object)
+            lengths = np.array([len(seq) for seq in seqs])
+            batches = bucketing.length_buckets(lengths, batch_size=batch_size, padding_budget=self.padding_budget or 0)
+            self.model.calibrate(self.encode(seqs[batch]) for batch in batches)
         
         # One-hot encodes a particular sequence
         def encode_seq(self, seq, max_len):
-            # Add padding:
-            if max_len == 0:
-                padding_needed = 0
-            else:
-                padding_needed = max_len - len(seq)
-            seq = seq.upper() # force upper case to be sure!
-            seq = "N"*padding_needed + seq
-            # One hot encode
+            return self.encode([seq], max_len)[0]
+        
+        # One-hot encodes the entire tensor
+        def encode(self, inputs, max_len=0):
             try:
-                one_hot = np.array([self.nuc_dict[x] for x in seq]) # get stacked on top of each other
-            except KeyError as e:
+                one_hot = seq_encoding.one_hot_encode(inputs, max_len=max_len)
+            except seq_encoding.UnknownBaseError as e:
                 raise ValueError('Cant one-hot encode unkown base: {} in seq: {}. \
                                  Possible cause: a variant in the vcf file is defined by tag (<..>). \
-                                 If so, please filter'.format(str(e), seq))
+                                 If so, please filter'.format(str(e), e.seq))
             return one_hot
         
-        # One-hot encodes the entire tensor
-        def encode(self, inputs):
-            # One Hot Encode input
-            max_len = len(max(inputs, key=len))
-            one_hot = np.stack([self.encode_seq(seq, max_len) 
-                                for seq in inputs],  axis = 0)
-            return one_hot
+        # Predicts the mrl for the sequences as given and with the frame shifted by one and two
+        # Returns an array of shape (n, 3)
+        def predict_shifts(self, one_hot, indicator):
+            if self.pooling_fn is None:
+                preds = []
+                for shift in range(3):
+                    if shift > 0:
+                        shifter = np.zeros((one_hot.shape[0],1,4))
+                        one_hot = np.concatenate([one_hot, shifter], axis=1)
+                    preds.append(self.model.predict_on_batch([one_hot, indicator]).reshape(-1))
+                return np.stack(preds, axis=1)
+            return self.predict_shifts_from_pooled(self.pooling_fn(one_hot), indicator)
+        
+        # Runs the dense head on frame-wise pooled features, for all three shifts
+        def predict_shifts_from_pooled(self, pooled, indicator):
+            # Appending a zero position moves every real position into the next frame
+            # (the appended position is masked), i.e. it rotates the frame-wise pooled features
+            n = pooled.shape[0]
+            pooled = pooled.reshape(n, -1, 3, self.n_filters)
+            shifted = np.concatenate([np.roll(pooled, shift, axis=2).reshape(n, -1) for shift in range(3)])
+            preds = self.head_fn(shifted, np.concatenate([indicator]*3))
+            return preds.reshape(3, n).T
+        
+        # Predicts shifts for a batch of sequences, in sub-batches of similar length
+        # so that a single long utr does not force the whole batch to be padded to its length
+        def predict_bucketed(self, seqs, indicator):
+            preds = np.empty((len(seqs), 3))
+            if len(seqs) == 0:
+                return preds
+            lengths = np.array([len(seq) for seq in seqs])
+            if self.padding_budget is None:
+                batches = [np.arange(len(seqs))]
+            else:
+                batches = bucketing.length_buckets(lengths, batch_size=len(seqs), 
+                                                   padding_budget=self.padding_budget)
+            for batch in batches:
+                one_hot = self.encode(seqs[batch])
+                preds[batch] = self.predict_shifts(one_hot, indicator[batch])
+                self.padding_stats["padded"] += one_hot.shape[0]*one_hot.shape[1]
+            self.padding_stats["nucleotides"] += int(np.sum(lengths))
+            self.padding_stats["padded_unbucketed"] += len(seqs)*int(np.max(lengths))
+            return preds
+        
+        # Predicts every distinct key once, skipping keys that are in the prediction cache.
+        # predict_fn gets the indices of the sequences to send to the model
+        def predict_unique(self, keys, predict_fn):
+            if len(keys) == 0:
+                return np.empty((0, 3))
+            cached = self.cache.get_many(keys) if self.cache is not None else [None]*len(keys)
+            unseen = {}
+            for i, (key, value) in enumerate(zip(keys, cached)):
+                if value is None and key not in unseen:
+                    unseen[key] = i
+            new_preds = predict_fn(np.array(list(unseen.values()), dtype=int))
+            if self.cache is not None:
+                self.cache.put_many(list(unseen.keys()), new_preds)
+            new_preds = dict(zip(unseen.keys(), new_preds))
+            return np.stack([new_preds[key] if value is None else value for key, value in zip(keys, cached)])
+        
+        # Predicts shifts for a batch of sequences, only sending sequences to the model
+        # which are not in the prediction cache (each distinct sequence once, also without a
+        # cache, e.g. the shared reference of per-variant items)
+        def predict_cached(self, seqs, indicator):
+            if self.cache is None:
+                keys = list(seqs)
+            else:
+                keys = [prediction_cache.sequence_hash(seq) for seq in seqs]
+            return self.predict_unique(keys, lambda idx: self.predict_bucketed(seqs[idx], indicator[idx]))
+        
+        # predict_bucketed for left-padded code matrices (see seq_encoding), e.g. from the
+        # dataloader's get_batch: sub-batches are cut from the matrix without going through strings
+        def predict_codes_bucketed(self, code_mat, lengths, indicator):
+            preds = np.empty((len(lengths), 3))
+            if len(lengths) == 0:
+                return preds
+            if self.padding_budget is None:
+                batches = [np.arange(len(lengths))]
+            else:
+                batches = bucketing.length_buckets(lengths, batch_size=len(lengths),
+                                                   padding_budget=self.padding_budget)
+            for batch in batches:
+                width = int(np.max(lengths[batch]))
+                one_hot = seq_encoding.one_hot_from_codes(code_mat[batch, code_mat.shape[1] - width:])
+                preds[batch] = self.predict_shifts(one_hot, indicator[batch])
+                self.padding_stats["padded"] += one_hot.shape[0]*one_hot.shape[1]
+            self.padding_stats["nucleotides"] += int(np.sum(lengths))
+            self.padding_stats["padded_unbucketed"] += len(lengths)*int(np.max(lengths))
+            return preds
+        
+        # predict_cached for code matrices
+        def predict_codes_cached(self, code_mat, lengths, indicator):
+            rows = [code_mat[i, code_mat.shape[1] - length:] for i, length in enumerate(lengths)]
+            if self.cache is None:
+                keys = [row.tobytes() for row in rows]
+            else:
+                keys = [prediction_cache.codes_hash(row) for row in rows]
+            return self.predict_unique(keys, lambda idx: self.predict_codes_bucketed(
+                code_mat[idx], lengths[idx], indicator[idx]))
+        
+        # Fraction of encoded positions that were actual sequence (rather than padding),
+        # with bucketing and as it would have been without
+        def padding_efficiency(self):
+            stats = self.padding_stats
+            if stats["padded"] == 0:
+                return {"bucketed": 1.0, "unbucketed": 1.0}
+            return {"bucketed": stats["nucleotides"]/stats["padded"],
+                    "unbucketed": stats["nucleotides"]/stats["padded_unbucketed"]}
         
         # Predicts for a batch of inputs
         def predict_on_batch(self, inputs):
             if inputs.shape == (2,):
                 inputs = inputs[np.newaxis, :]
-            # Encode
-            max_len = len(max(inputs, key=len))
-            one_hot_ref =  self.encode(inputs[:,0])
-            one_hot_alt = self.encode(inputs[:,1])
             # Construct dummy library indicator
             indicator = np.zeros((inputs.shape[0],2))
             indicator[:,1] = 1
-            # Compute fold change for all three frames
-            fc_changes = []
-            for shift in range(3):
-                if shift > 0:
-                    shifter = np.zeros((one_hot_ref.shape[0],1,4))
-                    one_hot_ref = np.concatenate([one_hot_ref, shifter], axis=1)
-                    one_hot_alt = np.concatenate([one_hot_alt, shifter], axis=1)
-                pred_ref = self.model.predict_on_batch([one_hot_ref, indicator]).reshape(-1)
-                pred_variant = self.model.predict_on_batch([one_hot_alt, indicator]).reshape(-1)
-                fc_changes.append(np.log2(pred_variant/pred_ref))
+            # Compute fold change for all three frames. References and variants are predicted
+            # independently, so each is bucketed by its own length (not by max(ref, alt))
+            pred_ref = self.predict_cached(inputs[:,0], indicator)
+            pred_variant = self.predict_bucketed(inputs[:,1], indicator)
+            fc_changes = np.log2(pred_variant/pred_ref)
             # Return
-            return {"mrl_fold_change":fc_changes[0], 
-                    "shift_1":fc_changes[1],
-                    "shift_2":fc_changes[2]}
\ No newline at end of file
+            return {"mrl_fold_change":fc_changes[:,0], 
+                    "shift_1":fc_changes[:,1],
+                    "shift_2":fc_changes[:,2]}
+        
+        # predict_on_batch for a batch of the dataloader's get_batch (uint8 code matrices)
+        def predict_on_codes(self, batch):
+            for name in ["ref", "alt"]:
+                if np.any(batch[name] == seq_encoding.UNKNOWN_CODE):
+                    row = np.argwhere(batch[name] == seq_encoding.UNKNOWN_CODE)[0][0]
+                    raise ValueError('Cant one-hot encode unkown base in {} sequence of item {}. \
+                                     Possible cause: a variant in the vcf file is defined by tag (<..>). \
+                                     If so, please filter'.format(name, row))
+            indicator = np.zeros((len(batch["ref_lengths"]),2))
+            indicator[:,1] = 1
+            pred_ref = self.predict_codes_cached(batch["ref"], batch["ref_lengths"], indicator)
+            pred_variant = self.predict_codes_bucketed(batch["alt"], batch["alt_lengths"], indicator)
+            fc_changes = np.log2(pred_variant/pred_ref)
+            return {"mrl_fold_change":fc_changes[:,0], 
+                    "shift_1":fc_changes[:,1],
+                    "shift_2":fc_changes[:,2]}
+
+# Scores every item of a dataloader in batches, one row per item with its metadata and the
+# fold changes. With a per_variant dataloader the table is indexed by (variant string, utr id),
+# as a variant can lie in several overlapping utrs
+def score_dataloader(model, dataloader, batch_size=256):
+    import pandas as pd
+    tables = []
+    for start in range(0, len(dataloader), batch_size):
+        items = [dataloader[idx] for idx in range(start, min(start + batch_size, len(dataloader)))]
+        table = pd.DataFrame({key: [item["metadata"][key] for item in items] for key in items[0]["metadata"]})
+        preds = model.predict_on_batch(np.stack([item["inputs"] for item in items]))
+        for key, values in preds.items():
+            table[key] = values
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+    if getattr(dataloader, "per_variant", False):
+        table = table.set_index(["variants", "id"])
+    return table
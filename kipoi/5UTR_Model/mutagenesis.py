@@ -0,0 +1,87 @@
+import ast
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from delta_scoring import DeltaScorer
+
+BASES = "ACGT"
+OUTPUTS = ["mrl_fold_change", "shift_1", "shift_2"]
+
+# Predicts log2 fold changes (n, 3) for whole mutated sequences, in chunks to bound memory
+def score_sequences(variant_model, ref_pred, seqs, batch_size=256):
+    preds = np.empty((len(seqs), 3))
+    for i in range(0, len(seqs), batch_size):
+        batch = np.array(seqs[i:i+batch_size])
+        indicator = np.zeros((len(batch), 2))
+        indicator[:,1] = 1
+        preds[i:i+batch_size] = variant_model.predict_bucketed(batch, indicator)
+    return np.log2(preds/ref_pred)
+
+def saturation_mutagenesis(variant_model, seq, deletion_lengths=(), insertions=(),
+                           scorer=None, batch_size=256):
+    """Scores every single nucleotide substitution of a utr, and optionally short deletions
+        and insertions. Substitutions are scored with a DeltaScorer (only the receptive field
+        around each position is recomputed), indels by predicting the full mutated sequences.
+        Returns a dict of effect arrays, with a last axis of size 3 holding
+        mrl_fold_change, shift_1 and shift_2:
+        substitutions: (L, 4, 3) per position and base (ACGT), 0 for the reference base
+        deletions: (L, len(deletion_lengths), 3) for deleting that many bases starting at a position
+        insertions: (L + 1, len(insertions), 3) for inserting each string before a position
+        Impossible deletions (running past the end) are NaN."""
+    if scorer is None:
+        scorer = DeltaScorer(variant_model, batch_size=batch_size)
+    scorer.set_reference(seq)
+    length = len(seq)
+    ref_codes = scorer.codes
+    # All 3L substitutions (4 at unknown reference bases)
+    positions = np.repeat(np.arange(length), 4)
+    alt_codes = np.tile(np.arange(4, dtype=np.uint8), length)
+    substituted = alt_codes != ref_codes[positions]
+    result = scorer.score_snvs(positions[substituted],
+                               "".join(np.array(list(BASES))[alt_codes[substituted]]))
+    substitutions = np.zeros((length, 4, 3))
+    substitutions[positions[substituted], alt_codes[substituted]] = np.stack([result[key] for key in OUTPUTS], axis=1)
+    effects = {"substitutions": substitutions}
+    # Deletions
+    if len(deletion_lengths) > 0:
+        deletions = np.full((length, len(deletion_lengths), 3), np.nan)
+        for j, n_deleted in enumerate(deletion_lengths):
+            starts = np.arange(max(length - n_deleted + 1, 0))
+            seqs = [seq[:i] + seq[i+n_deleted:] for i in starts]
+            deletions[starts, j] = score_sequences(variant_model, scorer.ref_pred, seqs, batch_size)
+        effects["deletions"] = deletions
+    # Insertions
+    if len(insertions) > 0:
+        inserted = np.empty((length + 1, len(insertions), 3))
+        for j, insertion in enumerate(insertions):
+            seqs = [seq[:i] + insertion + seq[i:] for i in range(length + 1)]
+            inserted[:, j] = score_sequences(variant_model, scorer.ref_pred, seqs, batch_size)
+        effects["insertions"] = inserted
+    return effects
+
+# Runs saturation mutagenesis over many utrs, yielding (id, effects) one utr at a time
+# so memory stays bounded by the longest utr
+def scan_utrs(variant_model, seqs, ids=None, batch_size=256, **kwargs):
+    scorer = DeltaScorer(variant_model, batch_size=batch_size)
+    if ids is None:
+        ids = itertools.count()
+    for seq_id, seq in zip(ids, seqs):
+        yield seq_id, saturation_mutagenesis(variant_model, seq, scorer=scorer,
+                                             batch_size=batch_size, **kwargs)
+
+# Streams (transcript id, 5'utr sequence) from a position file such as Data/gencodev19_5utr_pos.csv
+# (columns EnsemblTranscriptID, chr, pos, strand; pos is a list of bed-style exon intervals)
+def utr_sequences(pos_file, fasta_file, chunksize=1000):
+    from kipoiseq.extractors import FastaStringExtractor
+    from pybedtools import Interval
+    fasta_extractor = FastaStringExtractor(fasta_file, use_strand=True, force_upper=True)
+    for chunk in pd.read_csv(pos_file, chunksize=chunksize):
+        for transcript_id, chrom, pos, strand in zip(chunk["EnsemblTranscriptID"], chunk["chr"],
+                                                     chunk["pos"], chunk["strand"]):
+            exons = [fasta_extractor.extract(Interval(chrom, start, end, strand=strand))
+                     for start, end in ast.literal_eval(pos)]
+            if strand == "-":
+                exons.reverse()
+            yield transcript_id, "".join(exons)
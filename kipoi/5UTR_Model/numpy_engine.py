@@ -0,0 +1,198 @@
+import json
+
+import numpy as np
+
+# Layers of a Framepool model (see Modelling/model.create_frame_slice_model) the engine can run
+SUPPORTED_LAYERS = {"InputLayer", "Conv1D", "Lambda", "Add", "FrameSliceLayer", "GlobalMaxPooling1D",
+                    "Concatenate", "Dense", "Dropout"}
+SUPPORTED_LAMBDAS = ("compute_pad_mask", "apply_pad_mask_", "pool_avg_frame_conv", "interaction_term")
+
+PRECISIONS = ("float32", "float16", "int8")
+
+ACTIVATIONS = {"relu": lambda x: np.maximum(x, 0), "linear": lambda x: x}
+
+# Reads the weights of one layer from a keras h5 file
+def read_layer_weights(weights_group, layer_name):
+    group = weights_group[layer_name]
+    weights = {}
+    for name in group.attrs["weight_names"]:
+        name = name.decode("utf8") if isinstance(name, bytes) else name
+        weights[name.split("/")[-1].split(":")[0]] = group[name][()]
+    return weights
+
+class NumpyFramepool:
+    """Runs a trained Framepool model with NumPy only (no keras/tensorflow).
+        Reads the architecture and the conv/dense weights from the keras h5 file and implements
+        the forward pass: convolutions (causal or same padding), pad masking, residual adds,
+        frame slicing, max and masked average pooling, dense layers and the scaling regression.
+        predict_on_batch takes the same [one_hot, indicator] inputs as the keras model.
+        precision="float16" keeps weights and activations in float16, precision="int8" quantizes
+        conv and dense weights per output channel and their inputs per layer (scales from
+        calibrate(), integer products accumulated in float32). Both are opt-in for bulk screening."""
+
+    def __init__(self, weights, precision="float32"):
+        import h5py
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision: {} (use one of {})".format(precision, ", ".join(PRECISIONS)))
+        self.precision = precision
+        # activations are kept in float16 for the float16 mode, matmuls always accumulate in float32
+        self.dtype = np.float16 if precision == "float16" else np.float32
+        self.calibrating = False
+        with h5py.File(weights, "r") as handle:
+            config = json.loads(handle.attrs["model_config"])
+            layers = {layer["name"]: layer for layer in config["config"]["layers"]}
+            for name, layer in layers.items():
+                if layer["class_name"] not in SUPPORTED_LAYERS or \
+                        (layer["class_name"] == "Lambda" and not name.startswith(SUPPORTED_LAMBDAS)):
+                    raise ValueError("Layer {} ({}) is not supported by the numpy engine".format(
+                        name, layer["class_name"]))
+            weights_group = handle["model_weights"]
+            # Convolutions
+            self.conv_layers = []
+            i = 0
+            while "convolution_"+str(i) in layers:
+                layer_config = layers["convolution_"+str(i)]["config"]
+                layer_weights = read_layer_weights(weights_group, "convolution_"+str(i))
+                layer = self.store_kernel(layer_weights["kernel"])
+                layer.update({"bias": layer_weights["bias"].astype(np.float32),
+                              "dilation": layer_config["dilation_rate"][0],
+                              "padding": layer_config["padding"],
+                              "activation": ACTIVATIONS[layer_config["activation"]],
+                              "residual": "add_residual_"+str(i) in layers})
+                self.conv_layers.append(layer)
+                i += 1
+            self.n_filters = self.conv_layers[-1]["kernel"].shape[-1]
+            self.only_max_pool = "pool_avg_frame_conv" not in layers
+            # the nonframe models pool over the whole sequence
+            self.framed = "frame_masking" in layers
+            # Dense head
+            self.dense_layers = []
+            i = 0
+            while "fully_connected_"+str(i) in layers:
+                self.dense_layers.append(self.read_dense(layers, weights_group, "fully_connected_"+str(i)))
+                i += 1
+            self.dense_layers.append(self.read_dense(layers, weights_group, "mrl_output_unscaled"))
+            # The scaling regression (4 weights) always stays in float32
+            self.scaling = None
+            if "scaling_regression" in layers:
+                self.scaling = read_layer_weights(weights_group, "scaling_regression")["kernel"].astype(np.float32)
+        self.n_pools = 1 if self.only_max_pool else 2
+
+    def read_dense(self, layers, weights_group, name):
+        layer_weights = read_layer_weights(weights_group, name)
+        layer = self.store_kernel(layer_weights["kernel"])
+        layer.update({"bias": layer_weights["bias"].astype(np.float32) if "bias" in layer_weights else 0,
+                      "activation": ACTIVATIONS[layers[name]["config"]["activation"]]})
+        return layer
+
+    # Stores a kernel in the working precision. int8 kernels are quantized symmetrically
+    # per output channel, the scales are applied to the (float32 accumulated) matmul output
+    def store_kernel(self, kernel):
+        if self.precision != "int8":
+            return {"kernel": kernel.astype(self.dtype), "kernel_scale": 1.0}
+        axes = tuple(range(kernel.ndim - 1))
+        scale = np.max(np.abs(kernel), axis=axes)/127
+        scale[scale == 0] = 1.0
+        return {"kernel": np.round(kernel/scale).astype(np.int8), "kernel_scale": scale.astype(np.float32),
+                "input_scale": None}
+
+    # Quantizes the input of a layer (int8 mode) and returns it with its scale. Input scales come
+    # from calibrate(), uncalibrated layers fall back to a per-batch scale
+    def quantize_input(self, x, layer):
+        if self.calibrating:
+            layer["input_max"] = max(layer.get("input_max", 0.0), float(np.max(np.abs(x), initial=0)))
+        if self.precision != "int8" or self.calibrating:
+            return x.astype(np.float32, copy=False), 1.0
+        scale = layer["input_scale"]
+        if scale is None:
+            scale = max(float(np.max(np.abs(x), initial=0)), 1e-8)/127
+        return np.clip(np.round(x/scale), -127, 127).astype(np.float32), scale
+
+    # Sets the int8 activation scales from the largest input each layer sees on a sample of
+    # (one-hot encoded) sequences, such as MPRA utrs from data_dict
+    def calibrate(self, one_hot_batches):
+        layers = self.conv_layers + self.dense_layers
+        for layer in layers:
+            layer.pop("input_max", None)
+        self.calibrating = True
+        try:
+            for one_hot in one_hot_batches:
+                indicator = np.tile([[0.0, 1.0]], (len(one_hot), 1))
+                self.head(self.pooled_features(one_hot), indicator)
+        finally:
+            self.calibrating = False
+        if self.precision == "int8":
+            for layer in layers:
+                layer["input_scale"] = max(layer.get("input_max", 0.0), 1e-8)/127
+        return self
+
+    # Memory held by the conv and dense weights
+    def weight_bytes(self):
+        return sum(layer["kernel"].nbytes + np.asarray(layer["bias"]).nbytes
+                   for layer in self.conv_layers + self.dense_layers)
+
+    # Kernel size, dilation and padding of every convolution
+    def conv_layer_configs(self):
+        return [(layer["kernel"].shape[0], layer["dilation"], layer["padding"]) for layer in self.conv_layers]
+
+    def convolve(self, x, layer):
+        kernel, dilation = layer["kernel"].astype(np.float32, copy=False), layer["dilation"]
+        x, x_scale = self.quantize_input(x, layer)
+        length = x.shape[1]
+        span = (kernel.shape[0] - 1)*dilation
+        left = span if layer["padding"] == "causal" else span // 2
+        x = np.pad(x, ((0, 0), (left, span - left), (0, 0)))
+        out = np.zeros((x.shape[0], length, kernel.shape[-1]), dtype=np.float32)
+        for k in range(kernel.shape[0]):
+            out += x[:, k*dilation:k*dilation+length] @ kernel[k]
+        out = layer["activation"](out*(x_scale*layer["kernel_scale"]) + layer["bias"])
+        return out.astype(self.dtype, copy=False)
+
+    # Masked output of the convolution stack, (n, L, n_filters)
+    def conv_features(self, one_hot):
+        x = np.asarray(one_hot, dtype=self.dtype)
+        mask = np.sum(x, axis=2)[:, :, np.newaxis]
+        for layer in self.conv_layers:
+            features = self.convolve(x, layer)*mask
+            if layer["residual"]:
+                features = features + x
+            x = features
+        return x
+
+    # Frame-wise max (and masked average) pooling, frames counted from the end of the sequence
+    def pool(self, features, mask):
+        features = features[:, ::-1]
+        mask = mask[:, ::-1]
+        if self.framed:
+            frames = [(features[:, k::3], mask[:, k::3]) for k in range(3)]
+        else:
+            frames = [(features, mask)]
+        pooled = [np.max(frame, axis=1, initial=0) for frame, _ in frames]
+        if not self.only_max_pool:
+            # sums accumulate in float32, float16 would lose precision over long utrs
+            pooled = pooled + [np.sum(frame, axis=1, dtype=np.float32) /
+                               np.sum(frame_mask, axis=1, keepdims=True, dtype=np.float32)
+                               for frame, frame_mask in frames]
+        return np.concatenate(pooled, axis=1).astype(np.float32)
+
+    def pooled_features(self, one_hot):
+        one_hot = np.asarray(one_hot, dtype=self.dtype)
+        return self.pool(self.conv_features(one_hot), np.sum(one_hot, axis=2))
+
+    # Dense layers and scaling regression on pooled features
+    def head(self, pooled, indicator=None):
+        predict = np.asarray(pooled, dtype=np.float32)
+        for layer in self.dense_layers:
+            x, x_scale = self.quantize_input(predict, layer)
+            predict = x @ layer["kernel"].astype(np.float32, copy=False)
+            predict = layer["activation"](predict*(x_scale*layer["kernel_scale"]) + layer["bias"])
+        if self.scaling is not None:
+            indicator = np.asarray(indicator, dtype=np.float32)
+            predict = np.concatenate([predict*indicator, indicator], axis=1) @ self.scaling
+        return predict
+
+    def predict_on_batch(self, inputs):
+        if self.scaling is None:
+            return self.head(self.pooled_features(inputs))
+        one_hot, indicator = inputs
+        return self.head(self.pooled_features(one_hot), indicator)
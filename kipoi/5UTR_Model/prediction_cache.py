@@ -0,0 +1,100 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+# Rough per-entry bookkeeping cost of the in-memory cache (dict slot, key and array objects)
+ENTRY_OVERHEAD = 200
+
+# Hashes a file (e.g. the model weights) in chunks
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Hashes a sequence, normalised the same way the encoder treats it (case, U == T)
+def sequence_hash(seq):
+    return hashlib.sha1(seq.upper().replace("U", "T").encode("latin-1", errors="replace")).hexdigest()
+
+# Upper case base of every seq_encoding code (A, C, G, T, N, X)
+CODE_BASES = np.frombuffer(b"ACGTNX", dtype=np.uint8)
+
+# Hash of a sequence given as seq_encoding codes, equal to the sequence_hash of its string
+def codes_hash(codes):
+    return hashlib.sha1(CODE_BASES[codes].tobytes()).hexdigest()
+
+class PredictionCache:
+    """Caches model predictions per sequence.
+        Entries live in an in-memory LRU bounded by max_bytes, and are optionally persisted
+        to a sqlite file, keyed by the hash of the model weights and the sequence hash,
+        so that reruns with the same model can reuse them."""
+
+    def __init__(self, weights_hash, max_bytes=64 << 20, store_path=None):
+        self.weights_hash = weights_hash
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.store = None
+        if store_path is not None:
+            self.store = sqlite3.connect(store_path, check_same_thread=False)
+            self.store.execute("CREATE TABLE IF NOT EXISTS predictions "
+                               "(weights_hash TEXT, seq_hash TEXT, value BLOB, "
+                               "PRIMARY KEY (weights_hash, seq_hash))")
+            self.store.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry_size(self, key, value):
+        return len(key) + value.nbytes + ENTRY_OVERHEAD
+
+    # Adds to the in-memory LRU, evicting the least recently used entries beyond the budget
+    def remember(self, key, value):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = value
+        self.n_bytes += self.entry_size(key, value)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 0:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.n_bytes -= self.entry_size(old_key, old_value)
+
+    def load(self, keys):
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = self.store.execute("SELECT seq_hash, value FROM predictions WHERE weights_hash = ? "
+                                      "AND seq_hash IN ({})".format(",".join("?"*len(chunk))),
+                                      [self.weights_hash] + chunk)
+            for key, value in rows:
+                found[key] = np.frombuffer(value, dtype=np.float64)
+        return found
+
+    # Returns the cached value for each key, or None if it is not cached
+    def get_many(self, keys):
+        values = [self.entries.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if self.store is not None and len(missing) > 0:
+            loaded = self.load(list(set(missing)))
+            values = [loaded.get(key) if value is None else value for key, value in zip(keys, values)]
+        for key, value in zip(keys, values):
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.remember(key, value)
+        return values
+
+    def put_many(self, keys, values):
+        values = [np.asarray(value, dtype=np.float64) for value in values]
+        for key, value in zip(keys, values):
+            self.remember(key, value)
+        if self.store is not None:
+            self.store.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                                   [(self.weights_hash, key, value.tobytes()) for key, value in zip(keys, values)])
+            self.store.commit()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precompiled store of 5'UTR reference sequences.
+
+The build step extracts every transcript's exons once from the fasta and writes a directory of
+memory-mappable arrays: the sequence 2-bit packed (4 bases per byte, genomic orientation, exons
+of a transcript concatenated), base offsets and exon coordinates per transcript, and the
+positions of all non-ACGT bases. Sequences are strand-corrected when read, variants (given in
+genomic coordinates) are applied before strand correction.
+
+Usage: python reference_store.py --bed gencodev19_5utr_sorted.bed --fasta genome.fa --out utr_store
+       python reference_store.py --pos-file ../../Data/gencodev19_5utr_pos.csv --fasta genome.fa --out utr_store
+"""
+
+import os
+import ast
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import seq_encoding
+import interval_index
+
+ARRAYS = ["sequence", "seq_offsets", "exon_offsets", "exon_starts", "exon_ends", "exception_pos", "exception_bases"]
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+# 2-bit codes of the four bases (upper case only, anything else is stored as an exception)
+PACK_CODES = np.full(256, 255, dtype=np.uint8)
+for _base, _code in zip(b"ACGT", [seq_encoding.A, seq_encoding.C, seq_encoding.G, seq_encoding.T]):
+    PACK_CODES[_base] = _code
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+# Variant as (0-based start, ref, alt), for kipoiseq Variants and cyvcf2-style records
+def variant_tuple(variant):
+    if hasattr(variant, "pos"):
+        return variant.pos - 1, variant.ref, variant.alt
+    return variant.POS - 1, variant.REF, variant.ALT[0]
+
+# Applies variants to the (genomic orientation) sequence of the interval starting at start,
+# exactly like VariantSeqExtractor.extract(..., anchor=0, fixed_len=False) (kipoiseq 0.7): variants
+# reaching over the interval borders are cut (ref and alt at the same offset) and all variants are
+# applied in start order, overlapping ones included. Each alt follows the reference up to its
+# start (none if an earlier variant reached past it) and the reference resumes after its ref, so
+# both records of a split multi-allelic site are inserted (C>A, C>G gives AG) and an SNV within
+# an earlier deletion brings back the deleted bases after it
+def apply_variants(seq, start, variants):
+    end = start + len(seq)
+    cut_variants = []
+    for var_start, ref, alt in (variant_tuple(variant) for variant in variants):
+        if var_start + len(ref) <= start or var_start >= end:
+            continue
+        if var_start < start:
+            cut = start - var_start
+            ref, alt, var_start = ref[cut:], alt[cut:], start
+        if var_start + len(ref) > end:
+            cut = end - var_start
+            ref, alt = ref[:cut], alt[:cut]
+        cut_variants.append((var_start, ref, alt))
+    pieces = []
+    prev = start
+    # stable, variants with the same start stay in the given (vcf) order
+    for var_start, ref, alt in sorted(cut_variants, key=lambda v: v[0]):
+        pieces.append(seq[prev - start:max(var_start, prev) - start])
+        pieces.append(alt)
+        prev = var_start + len(ref)
+    pieces.append(seq[prev - start:])
+    return "".join(pieces)
+
+# Transcripts of a bed file as (id, chr, strand, [(start, end), ...]), grouped like the dataloader does
+def bed_transcripts(bed_file, strand_column=6, id_column=4, num_chr=True):
+    bed = pd.read_csv(bed_file, sep="\t", header=None, comment="#", dtype={0: str})
+    ids = bed.iloc[:, id_column - 1].values.astype(str)
+    chroms = interval_index.normalize_chroms(bed.iloc[:, 0], num_chr).astype(str)
+    strands = bed.iloc[:, strand_column - 1].values.astype(str)
+    order, group_starts = interval_index.group_rows(ids, chroms, strands)
+    exons = list(zip(bed.iloc[:, 1].values[order].tolist(), bed.iloc[:, 2].values[order].tolist()))
+    group_ends = np.append(group_starts[1:], len(order))
+    for start, end in zip(group_starts, group_ends):
+        row = order[start]
+        yield ids[row], chroms[row], strands[row], exons[start:end]
+
+# Transcripts of a position file such as Data/gencodev19_5utr_pos.csv
+def pos_file_transcripts(pos_file, num_chr=True):
+    df = pd.read_csv(pos_file, dtype={"chr": str})
+    chroms = interval_index.normalize_chroms(df["chr"], num_chr).astype(str)
+    for transcript_id, chrom, pos, strand in zip(df["EnsemblTranscriptID"], chroms, df["pos"], df["strand"]):
+        yield str(transcript_id), chrom, strand, [tuple(exon) for exon in ast.literal_eval(pos)]
+
+def build_reference_store(transcripts, fasta_file, out_dir):
+    """Extracts the exons of all transcripts (id, chr, strand, exons) from the fasta
+        and writes the store to out_dir"""
+    from kipoiseq.extractors import FastaStringExtractor
+    from pybedtools import Interval
+    fasta_extractor = FastaStringExtractor(fasta_file, use_strand=False, force_upper=True)
+    os.makedirs(out_dir, exist_ok=True)
+    table = {"id": [], "chr": [], "strand": []}
+    codes, seq_lengths, exon_counts, exon_starts, exon_ends = [], [], [], [], []
+    for transcript_id, chrom, strand, exons in transcripts:
+        seq = "".join(fasta_extractor.extract(Interval(chrom, start, end)) for start, end in exons)
+        codes.append(np.frombuffer(seq.encode("ascii"), dtype=np.uint8))
+        seq_lengths.append(len(seq))
+        exon_counts.append(len(exons))
+        exon_starts.extend(start for start, _ in exons)
+        exon_ends.extend(end for _, end in exons)
+        table["id"].append(transcript_id)
+        table["chr"].append(chrom)
+        table["strand"].append(strand)
+    ascii_seq = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint8)
+    packed_codes = PACK_CODES[ascii_seq]
+    exceptions = np.where(packed_codes == 255)[0]
+    packed_codes[exceptions] = 0
+    packed_codes = np.concatenate([packed_codes, np.zeros(-len(packed_codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+    arrays = {"sequence": (packed_codes << np.array([0, 2, 4, 6], dtype=np.uint8)).sum(axis=1, dtype=np.uint8),
+              "seq_offsets": np.concatenate([[0], np.cumsum(seq_lengths)]).astype(np.int64),
+              "exon_offsets": np.concatenate([[0], np.cumsum(exon_counts)]).astype(np.int64),
+              "exon_starts": np.array(exon_starts, dtype=np.int64),
+              "exon_ends": np.array(exon_ends, dtype=np.int64),
+              "exception_pos": exceptions.astype(np.int64),
+              "exception_bases": ascii_seq[exceptions]}
+    for name in ARRAYS:
+        np.save(os.path.join(out_dir, name + ".npy"), arrays[name])
+    pd.DataFrame(table).to_csv(os.path.join(out_dir, "transcripts.tsv"), sep="\t", index=False)
+    with open(os.path.join(out_dir, "store.json"), "w") as handle:
+        json.dump({"fasta_file": os.path.abspath(fasta_file), "transcripts": len(table["id"]),
+                   "bases": int(len(ascii_seq)), "exceptions": int(len(exceptions))}, handle)
+    return ReferenceStore(out_dir)
+
+class ReferenceStore:
+    """Read access to a store written by build_reference_store. The arrays are memory mapped,
+        so opening is cheap and the pages are shared between processes."""
+
+    def __init__(self, path):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        transcripts = pd.read_csv(os.path.join(path, "transcripts.tsv"), sep="\t", dtype=str)
+        self.ids = transcripts["id"].values
+        self.chroms = transcripts["chr"].values
+        self.strands = transcripts["strand"].values
+        self.rows = {transcript_id: row for row, transcript_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def exons(self, row):
+        exon_slice = slice(self.exon_offsets[row], self.exon_offsets[row + 1])
+        return list(zip(self.exon_starts[exon_slice].tolist(), self.exon_ends[exon_slice].tolist()))
+
+    # Row of a transcript, or None if it is not in the store or its chromosome/exons differ
+    def find(self, transcript_id, chrom=None, exons=None):
+        row = self.rows.get(transcript_id)
+        if row is None:
+            return None
+        if chrom is not None and self.chroms[row] != str(chrom):
+            return None
+        if exons is not None and self.exons(row) != [(int(start), int(end)) for start, end in exons]:
+            return None
+        return row
+
+    # Genomic orientation sequence of the bases [start, end) of the store
+    def decode(self, start, end):
+        packed = np.asarray(self.sequence[start // 4:(end + 3) // 4])
+        codes = (packed[:, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+        seq = BASES[codes.reshape(-1)[start % 4:start % 4 + end - start]]
+        first, last = np.searchsorted(self.exception_pos, [start, end])
+        if last > first:
+            seq[np.asarray(self.exception_pos[first:last]) - start] = self.exception_bases[first:last]
+        return seq.tobytes().decode("ascii")
+
+    # Base range of exon k of a transcript in the store
+    def exon_range(self, row, k):
+        exon = self.exon_offsets[row] + k
+        lengths = np.asarray(self.exon_ends[self.exon_offsets[row]:exon]) - \
+                  np.asarray(self.exon_starts[self.exon_offsets[row]:exon])
+        start = int(self.seq_offsets[row] + np.sum(lengths))
+        return start, start + int(self.exon_ends[exon] - self.exon_starts[exon])
+
+    # Reference sequence of exon k, on the strand of the transcript
+    def exon_sequence(self, row, k):
+        seq = self.decode(*self.exon_range(row, k))
+        return reverse_complement(seq) if self.strands[row] == "-" else seq
+
+    # Sequence of exon k with variants (genomic coordinates) applied, on the strand of the transcript
+    def exon_variant_sequence(self, row, k, variants):
+        seq = apply_variants(self.decode(*self.exon_range(row, k)),
+                             int(self.exon_starts[self.exon_offsets[row] + k]), variants)
+        return reverse_complement(seq) if self.strands[row] == "-" else seq
+
+    # Full strand-corrected 5'utr of a transcript
+    def utr_sequence(self, row):
+        seq = self.decode(int(self.seq_offsets[row]), int(self.seq_offsets[row + 1]))
+        return reverse_complement(seq) if self.strands[row] == "-" else seq
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a precompiled 5'UTR reference sequence store.")
+    parser.add_argument("--bed", help="bed3+ file with the utr exons (like the dataloader intervals_file).")
+    parser.add_argument("--pos-file", help="Alternatively, a position file like Data/gencodev19_5utr_pos.csv.")
+    parser.add_argument("--fasta", required=True, help="Reference genome fasta (with .fai index).")
+    parser.add_argument("--out", required=True, help="Output directory of the store.")
+    parser.add_argument("--strand-column", type=int, default=6)
+    parser.add_argument("--id-column", type=int, default=4)
+    parser.add_argument("--num-chr", type=int, default=1,
+                        help="1 if chromosomes are numeric (no chr prefix), 0 otherwise (as in the dataloader).")
+    args = parser.parse_args()
+    if (args.bed is None) == (args.pos_file is None):
+        parser.error("give exactly one of --bed and --pos-file")
+    if args.bed is not None:
+        transcripts = bed_transcripts(args.bed, args.strand_column, args.id_column, bool(args.num_chr))
+    else:
+        transcripts = pos_file_transcripts(args.pos_file, bool(args.num_chr))
+    store = build_reference_store(transcripts, args.fasta, args.out)
+    print("Stored {} transcripts in {}".format(len(store), args.out))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import numpy as np
+
+# Integer codes used for nucleotides. Padding is encoded as N.
+A, C, G, T, N, X = 0, 1, 2, 3, 4, 5
+PAD_CODE = N
+UNKNOWN_CODE = 255
+
+# Lookup table mapping every byte to its nucleotide code (upper and lower case, U == T)
+NUC_CODES = np.full(256, UNKNOWN_CODE, dtype=np.uint8)
+for _bases, _code in [("Aa", A), ("Cc", C), ("Gg", G), ("TtUu", T), ("Nn", N), ("Xx", X)]:
+    for _base in _bases:
+        NUC_CODES[ord(_base)] = _code
+
+# One-hot row for every code
+CODE_ONE_HOT = np.array([[1.0, 0.0, 0.0, 0.0],
+                         [0.0, 1.0, 0.0, 0.0],
+                         [0.0, 0.0, 1.0, 0.0],
+                         [0.0, 0.0, 0.0, 1.0],
+                         [0.0, 0.0, 0.0, 0.0],
+                         [1/4, 1/4, 1/4, 1/4]], dtype=np.float32)
+
+# Raised for characters that have no nucleotide code (a KeyError, like the old dict lookups)
+class UnknownBaseError(KeyError):
+
+    def __init__(self, base, seq):
+        self.seq = seq
+        super().__init__(base)
+
+# Maps a batch of strings to one flat array of codes, plus the length of every string
+def to_codes(seqs):
+    seqs = list(seqs)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    # latin-1 keeps one byte per character, anything outside ends up as an unknown code
+    flat = np.frombuffer("".join(seqs).encode("latin-1", errors="replace"), dtype=np.uint8)
+    return NUC_CODES[flat], lengths
+
+# Left-pads (with N) or left-truncates flat codes into a (n, width) matrix
+def pad_codes(codes, lengths, width, out=None):
+    return gather_codes(codes, np.cumsum(lengths) - lengths, lengths, width, out)
+
+# Like pad_codes, for sequences that start anywhere in codes (e.g. a batch of rows of a code store)
+def gather_codes(codes, offsets, lengths, width, out=None):
+    n = len(lengths)
+    if out is None:
+        out = np.empty((n, width), dtype=np.uint8)
+    out.fill(PAD_CODE)
+    kept = np.minimum(lengths, width)
+    total = int(np.sum(kept))
+    if total == 0:
+        return out
+    # position of every kept nucleotide within its own kept suffix
+    within = np.arange(total) - np.repeat(np.cumsum(kept) - kept, kept)
+    rows = np.repeat(np.arange(n), kept)
+    cols = np.repeat(width - kept, kept) + within
+    src = np.repeat(offsets + lengths - kept, kept) + within
+    out[rows, cols] = codes[src]
+    return out
+
+# Determines the padded width, following the max_len/min_len conventions of the encoders
+def padded_width(lengths, max_len=0, min_len=None):
+    if min_len is not None:
+        return min_len
+    longest = int(lengths.max()) if len(lengths) > 0 else 0
+    return max(longest, max_len)
+
+# Raises a KeyError naming the first base that could not be encoded
+def check_codes(code_mat, seqs, lengths):
+    bad = np.argwhere(code_mat == UNKNOWN_CODE)
+    if len(bad) > 0:
+        row, col = bad[0]
+        pos = lengths[row] - (code_mat.shape[1] - col)
+        raise UnknownBaseError(seqs[row][pos], seqs[row])
+
+# Turns a code matrix into a float32 one-hot tensor
+def one_hot_from_codes(code_mat):
+    return CODE_ONE_HOT[code_mat]
+
+# Encodes a batch of strings into a left-padded (n, width, 4) float32 one-hot tensor
+def one_hot_encode(seqs, max_len=0, min_len=None):
+    seqs = list(seqs)
+    codes, lengths = to_codes(seqs)
+    code_mat = pad_codes(codes, lengths, padded_width(lengths, max_len, min_len))
+    check_codes(code_mat, seqs, lengths)
+    return one_hot_from_codes(code_mat)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup/throughput comparison of the keras and numpy Framepool backends,
+and accuracy/throughput/memory report of the reduced-precision (float16, int8) numpy modes.
+(Parity of the two backends is checked by tests/test_numpy_engine.py)
+
+Sequences are sampled with the 5'UTR lengths of the bundled GENCODE bed (TestFiles) and
+predicted with both backends. Startup (imports + model load + first prediction) is measured
+in a fresh interpreter per backend. The int8 mode is calibrated
+on a sample of MPRA utrs from data_dict (Data/data_dict.pkl, see README), or on
+sampled sequences if it is not available.
+
+Usage: python benchmark_backends.py [--weights ...] [--n 2000] [--batch-size 64] [--precisions float16,int8]
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "5UTR_Model")
+sys.path.append(MODEL_DIR)
+
+STARTUP_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+sys.path.append({model_dir!r})
+import numpy as np
+from model import UTRVariantEffectModel
+model = UTRVariantEffectModel({weights!r}, backend={backend!r})
+model.predict_on_batch(np.array(["ACGTACGTAAAT", "ACGTACCTAAAT"]))
+print(time.perf_counter() - start)
+"""
+
+# Samples random sequences with the utr length distribution of a bed file
+# (utrs shorter than min_len have empty frames, their average pools are undefined)
+def sample_utrs(bed_file, n, seed=1337, min_len=10):
+    bed = pd.read_csv(bed_file, sep="\t", header=None)
+    lengths = (bed[2] - bed[1]).groupby(bed[3]).sum().values
+    lengths = lengths[lengths >= min_len]
+    rng = np.random.RandomState(seed)
+    lengths = rng.choice(lengths, size=n)
+    return ["".join(rng.choice(list("ACGT"), size=length)) for length in lengths]
+
+# Introduces one random substitution into every sequence
+def mutate(seqs, seed=1337):
+    rng = np.random.RandomState(seed)
+    mutated = []
+    for seq in seqs:
+        pos = rng.randint(len(seq))
+        mutated.append(seq[:pos] + rng.choice([b for b in "ACGT" if b != seq[pos]]) + seq[pos+1:])
+    return mutated
+
+def measure_startup(weights, backend):
+    snippet = STARTUP_SNIPPET.format(model_dir=MODEL_DIR, weights=weights, backend=backend)
+    output = subprocess.check_output([sys.executable, "-c", snippet])
+    return float(output.decode().strip().splitlines()[-1])
+
+def predict_all(model, inputs, batch_size):
+    preds = {}
+    start = time.perf_counter()
+    for i in range(0, len(inputs), batch_size):
+        for key, value in model.predict_on_batch(inputs[i:i+batch_size]).items():
+            preds.setdefault(key, []).append(value)
+    elapsed = time.perf_counter() - start
+    return {key: np.concatenate(value) for key, value in preds.items()}, elapsed
+
+# Sample of MPRA utrs (training sets) for calibrating the int8 mode
+def calibration_utrs(data_dict_file, n, bed_file, seed=1337):
+    if not os.path.exists(data_dict_file):
+        print("{} not found, calibrating on sampled sequences".format(data_dict_file))
+        return sample_utrs(bed_file, n, seed=seed + 1)
+    with open(data_dict_file, "rb") as handle:
+        data_dict = pickle.load(handle)
+    utrs = pd.concat([data_dict[key].loc[data_dict[key].set == "train", "utr"]
+                      for key in ["mpra", "varlen_mpra"]])
+    return list(utrs.sample(n=min(n, len(utrs)), random_state=seed))
+
+# Peak memory allocated while predicting a few batches
+def peak_memory(model, inputs, batch_size, n_batches=4):
+    tracemalloc.start()
+    predict_all(model, inputs[:n_batches*batch_size], batch_size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def compare_backends(args, inputs):
+    from model import UTRVariantEffectModel
+    for backend in ["keras", "numpy"]:
+        startup = measure_startup(args.weights, backend)
+        model = UTRVariantEffectModel(args.weights, backend=backend, cache_bytes=0)
+        _, elapsed = predict_all(model, inputs, args.batch_size)
+        print("{:6s} startup {:6.2f}s  throughput {:8.1f} pairs/s".format(backend, startup, len(inputs)/elapsed))
+
+def compare_precisions(args, inputs):
+    from model import UTRVariantEffectModel
+    calibration_seqs = calibration_utrs(args.data_dict, args.calibration_size, args.bed)
+    print("{:9s} {:>10s} {:>10s} {:>12s} {:>12s} {:>10s} {:>12s}".format(
+        "precision", "weights MB", "peak MB", "pairs/s", "pearson r", "max delta", "mean delta"))
+    reference = None
+    for precision in ["float32"] + args.precisions:
+        model = UTRVariantEffectModel(args.weights, backend="numpy", cache_bytes=0, precision=precision,
+                                      calibration_seqs=calibration_seqs if precision == "int8" else None)
+        preds, elapsed = predict_all(model, inputs, args.batch_size)
+        fold_change = preds["mrl_fold_change"]
+        if reference is None:
+            reference = fold_change
+        delta = np.abs(fold_change - reference)
+        print("{:9s} {:10.2f} {:10.1f} {:12.1f} {:12.6f} {:10.2e} {:12.2e}".format(
+            precision, model.model.weight_bytes()/2**20, peak_memory(model, inputs, args.batch_size)/2**20,
+            len(inputs)/elapsed, np.corrcoef(fold_change, reference)[0, 1], np.max(delta), np.mean(delta)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the keras and numpy Framepool backends and reduced precision modes.")
+    parser.add_argument("--weights", default=os.path.join(MODEL_DIR, "model", "Framepool_combined_residual.h5"))
+    parser.add_argument("--bed", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "TestFiles", "gencodev19_5utr_sorted.bed"))
+    parser.add_argument("--n", type=int, default=2000, help="Number of (ref, alt) pairs.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--skip-backends", action="store_true", help="Skip the keras/numpy comparison.")
+    parser.add_argument("--precisions", default="float16,int8",
+                        help="Reduced precisions of the numpy backend to compare against float32.")
+    parser.add_argument("--data-dict", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "..", "Data", "data_dict.pkl"))
+    parser.add_argument("--calibration-size", type=int, default=2000, help="MPRA utrs used for int8 calibration.")
+    args = parser.parse_args()
+
+    args.precisions = [p for p in args.precisions.split(",") if p]
+
+    refs = sample_utrs(args.bed, args.n)
+    inputs = np.array([refs, mutate(refs)]).T
+    if not args.skip_backends:
+        compare_backends(args, inputs)
+    if args.precisions:
+        compare_precisions(args, inputs)
+
+if __name__ == "__main__":
+    main()
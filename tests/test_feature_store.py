@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modelling"))
+from feature_store import FeatureStore
+
+# Precomputation with rows that cannot be stored (tuples), counting its calls
+class TuplePrecomputation:
+
+    def __init__(self, seq_col, new_col):
+        self.seq_col = seq_col
+        self.new_col = new_col
+        self.method = "direct"
+        self.calls = 0
+
+    def __call__(self, df):
+        self.calls += 1
+        return df[self.seq_col].apply(lambda seq: (seq[:1], len(seq)))
+
+# Precomputation reading the column of another precomputation
+class Doubler:
+
+    def __init__(self, seq_col, new_col):
+        self.seq_col = seq_col
+        self.new_col = new_col
+        self.dims = (1,)
+        self.method = "direct"
+        self.name = new_col
+
+    def __call__(self, df):
+        return df[self.seq_col]*2
+
+def utr_frame(n=50):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({"utr": ["".join(rng.choice(list("ACGT"), k)) for k in rng.randint(5, 30, n)],
+                         "rl": rng.rand(n)})
+
+def test_unstorable_rows_are_returned(tmp_path):
+    df = utr_frame()
+    fn = TuplePrecomputation("utr", "first")
+    feature, rows = FeatureStore(str(tmp_path)).get_or_compute(fn, df)
+    assert feature is None
+    assert fn.calls == 1
+    assert list(rows) == [(seq[:1], len(seq)) for seq in df["utr"]]
+
+def test_stored_rows_are_returned_once(tmp_path):
+    df = utr_frame()
+    fn = Doubler("rl", "rl2")
+    store = FeatureStore(str(tmp_path))
+    feature, rows = store.get_or_compute(fn, df)
+    assert np.array_equal(feature.take(np.arange(len(df))), rows.values)
+    feature, rows = store.get_or_compute(fn, df)
+    assert rows is None
+    assert np.array_equal(feature.series(df.index).values, df["rl"].values*2)
+
+def batches(sequence):
+    return [sequence[idx] for idx in range(len(sequence))]
+
+def test_datasequence_computes_unstorable_once(tmp_path):
+    utils_data = pytest.importorskip("utils_data")
+    fn = TuplePrecomputation("utr", "first")
+    sequence = utils_data.DataSequence(utr_frame(), precomputations=[fn], batch_size=16, shuffle=False,
+                                       feature_store=str(tmp_path))
+    assert fn.calls == 1
+    assert sequence.df["first"].iloc[0] == (sequence.df["utr"].iloc[0][:1], len(sequence.df["utr"].iloc[0]))
+
+# Stored features read by a later precomputation and by the output function, with the store
+# empty (computed) and filled (served from the store)
+def test_datasequence_stored_columns_read_later(tmp_path):
+    utils_data = pytest.importorskip("utils_data")
+    df = utr_frame()
+    def build(feature_store):
+        return utils_data.DataSequence(df, precomputations=[utils_data.SeqLenExtractor("utr", "len"),
+                                                            Doubler("len", "len2")],
+                                       output_encoding_fn=utils_data.DataFrameExtractor("len", method="direct"),
+                                       batch_size=16, shuffle=False, feature_store=feature_store)
+    expected = batches(build(None))
+    for _ in range(2):
+        for (inputs, output), (expected_inputs, expected_output) in zip(batches(build(str(tmp_path))), expected):
+            assert np.array_equal(output, expected_output)
+            assert all(np.array_equal(a, b) for a, b in zip(inputs, expected_inputs))
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import framepool_annotate
+
+# Stands in for the FramePool caller: returns the chunk as read back from its tsv
+def identity_caller(path):
+    return pd.read_csv(path, sep='\t')
+
+def read_output(path, output_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if output_format == "parquet":
+        return pq.read_table(path)
+    with pa.OSFile(path, "rb") as handle:
+        return pa.ipc.open_file(handle).read_all()
+
+def annotate(tmp_path, df, output_format, chunk_size=3):
+    input_path = str(tmp_path / "input.tsv")
+    df.to_csv(input_path, sep='\t', index=False)
+    output_path = str(tmp_path / "input.framepool.{}".format(output_format))
+    writer = framepool_annotate.ResultWriter(output_path, output_format)
+    framepool_annotate.annotate_streaming(input_path, writer, chunk_size, 1, 1)
+    writer.close()
+    return read_output(output_path, output_format)
+
+@pytest.fixture(autouse=True)
+def fake_caller(monkeypatch):
+    monkeypatch.setattr(framepool_annotate, "load_caller", lambda: identity_caller)
+
+# The dtype pandas infers for a chunk changes between chunks (all-NA first, strings later and
+# the other way round, integers with missing values in a later chunk)
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+@pytest.mark.parametrize("note", [[None]*3 + ["a", None, "b"], ["a", None, "b"] + [None]*3])
+def test_dtype_changes_between_chunks(tmp_path, output_format, note):
+    df = pd.DataFrame({"id": ["t{}".format(i) for i in range(6)],
+                       "count": pd.array([1, 2, 3, 4, None, 6], dtype="Int64"),
+                       "mrl_fold_change": np.linspace(0.5, 1.5, 6),
+                       "note": note})
+    table = annotate(tmp_path, df, output_format)
+    assert str(table.schema.field("note").type) == "dictionary<values=string, indices=int32, ordered=0>"
+    assert str(table.schema.field("count").type) == "int64"
+    assert str(table.schema.field("mrl_fold_change").type) == "float"
+    assert table.column("note").to_pylist() == note
+    assert table.column("count").to_pylist() == [1, 2, 3, 4, None, 6]
+    assert table.column("id").to_pylist() == list(df["id"])
+
+# A failed run leaves no truncated output behind
+def test_discard_removes_partial_output(tmp_path):
+    path = str(tmp_path / "out.parquet")
+    writer = framepool_annotate.ResultWriter(path, "parquet")
+    writer.write(pd.DataFrame({"id": ["a"], "mrl_fold_change": [1.0]}))
+    with pytest.raises(ValueError):
+        writer.write(pd.DataFrame({"id": ["b"]}))
+    writer.discard()
+    assert not os.path.exists(path)
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("keras")
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODEL_DIR = os.path.join(ROOT, "kipoi", "5UTR_Model")
+sys.path.append(MODEL_DIR)
+import numpy_engine
+import seq_encoding
+
+# Every model whose layers the numpy engine supports (the uORF and contribution models are not)
+SUPPORTED_WEIGHTS = [os.path.join(MODEL_DIR, "model", "Framepool_combined_residual.h5")] + \
+    [os.path.join(ROOT, "Models", name + ".h5") for name in
+     ["utr_model_50", "utr_model_100_residual", "utr_model_combined_residual", "utr_model_combined_residual_noTG",
+      "utr_model_nonframe_residual", "utr_model_nonframe_dilated_residual",
+      "utr_model_nonframe_more_dilated_residual"]]
+TOLERANCE = 1e-4
+
+# Random sequences with the utr lengths of the dataloader test bed
+# (utrs shorter than 10 bases have empty frames, their average pools are undefined)
+def sample_utrs(n=200, seed=1337):
+    bed = pd.read_csv(os.path.join(ROOT, "kipoi", "TestFiles", "gencodev19_5utr_sorted_noprefix.bed"),
+                      sep="\t", header=None)
+    lengths = (bed[2] - bed[1]).groupby(bed[3]).sum().values
+    rng = np.random.RandomState(seed)
+    lengths = rng.choice(lengths[lengths >= 10], size=n)
+    return ["".join(rng.choice(list("ACGT"), size=length)) for length in lengths]
+
+# Padded batches of similar lengths, as the model wrapper builds them
+def one_hot_batches(seqs, batch_size=32):
+    seqs = sorted(seqs, key=len)
+    return [seq_encoding.one_hot_encode(seqs[i:i+batch_size])
+            for i in range(0, len(seqs), batch_size)]
+
+@pytest.mark.parametrize("weights", SUPPORTED_WEIGHTS, ids=os.path.basename)
+def test_numpy_engine_matches_keras(weights):
+    from keras.models import load_model
+    from keras_layers import FrameSliceLayer
+    keras_model = load_model(weights, custom_objects={'FrameSliceLayer': FrameSliceLayer})
+    numpy_model = numpy_engine.NumpyFramepool(weights)
+    for one_hot in one_hot_batches(sample_utrs()):
+        inputs = one_hot
+        if numpy_model.scaling is not None:
+            # both experiment indicators
+            inputs = [one_hot, np.eye(2)[np.arange(len(one_hot)) % 2]]
+        np.testing.assert_allclose(numpy_model.predict_on_batch(inputs), keras_model.predict_on_batch(inputs),
+                                   rtol=TOLERANCE, atol=TOLERANCE)
+
+# The whole variant effect model (fold changes and frame shifts) on (ref, alt) pairs
+def test_variant_effect_model_backends_match():
+    pytest.importorskip("kipoi")
+    from model import UTRVariantEffectModel
+    refs = sample_utrs(n=100)
+    rng = np.random.RandomState(7)
+    alts = []
+    for seq in refs:
+        pos = rng.randint(len(seq))
+        alts.append(seq[:pos] + rng.choice([b for b in "ACGT" if b != seq[pos]]) + seq[pos+1:])
+    pairs = np.array([refs, alts]).T
+    preds = {}
+    for backend in ["keras", "numpy"]:
+        model = UTRVariantEffectModel(SUPPORTED_WEIGHTS[0], backend=backend, cache_bytes=0)
+        preds[backend] = model.predict_on_batch(pairs)
+    for key in ["mrl_fold_change", "shift_1", "shift_2"]:
+        np.testing.assert_allclose(preds["numpy"][key], preds["keras"][key], rtol=TOLERANCE, atol=TOLERANCE)
@@ -0,0 +1,112 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("kipoi")
+pytest.importorskip("kipoiseq")
+pytest.importorskip("pybedtools")
+pytest.importorskip("pyfaidx")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kipoi", "5UTR_Model"))
+import dataloader
+import reference_store
+
+CHROMS = ["1", "2"]
+CHROM_LENGTH = 3000
+
+# Synthetic genome, bed and vcf: multi-exon utrs on both strands with overlapping variants
+# (split multi-allelic sites, SNVs within deletions, insertions, variants across exon borders)
+@pytest.fixture(scope="module")
+def fixture_files(tmp_path_factory):
+    rng = np.random.RandomState(7)
+    path = tmp_path_factory.mktemp("utr_fixture")
+    genome = {chrom: "".join(rng.choice(list("ACGT"), CHROM_LENGTH)) for chrom in CHROMS}
+    with open(path / "genome.fa", "w") as handle:
+        for chrom in CHROMS:
+            handle.write(">{}\n{}\n".format(chrom, genome[chrom]))
+    bed_rows, variants = [], []
+    for chrom in CHROMS:
+        pos = 50
+        for t in range(20):
+            strand = "+" if t % 2 else "-"
+            for _ in range(rng.randint(1, 4)):
+                start, end = pos, pos + rng.randint(15, 40)
+                bed_rows.append((chrom, start, end, "T{}_{}".format(chrom, t), 0, strand))
+                for var_start in rng.choice(np.arange(start - 2, end), 3, replace=False):
+                    kind = rng.randint(4)
+                    ref = genome[chrom][var_start]
+                    if kind == 0:
+                        # multi-allelic site, split into one record per allele
+                        alts = [base for base in "ACGT" if base != ref][:2]
+                        variants += [(chrom, var_start, ref, alt) for alt in alts]
+                    elif kind == 1:
+                        # deletion with an SNV inside
+                        ref = genome[chrom][var_start:var_start + 4]
+                        variants.append((chrom, var_start, ref, ref[0]))
+                        inner = genome[chrom][var_start + 2]
+                        variants.append((chrom, var_start + 2, inner, "A" if inner != "A" else "C"))
+                    elif kind == 2:
+                        variants.append((chrom, var_start, ref, ref + "GT"))
+                    else:
+                        variants.append((chrom, var_start, ref, "A" if ref != "A" else "T"))
+                pos = end + rng.randint(5, 30)
+            pos += 40
+    with open(path / "utrs.bed", "w") as handle:
+        for row in bed_rows:
+            handle.write("\t".join(map(str, row)) + "\n")
+    variants = sorted(set(variants), key=lambda v: (CHROMS.index(v[0]), v[1]))
+    with open(path / "variants.vcf", "w") as handle:
+        handle.write("##fileformat=VCFv4.2\n")
+        for chrom in CHROMS:
+            handle.write("##contig=<ID={},length={}>\n".format(chrom, CHROM_LENGTH))
+        handle.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for chrom, var_start, ref, alt in variants:
+            handle.write("{}\t{}\t.\t{}\t{}\t.\t.\t.\n".format(chrom, var_start + 1, ref, alt))
+    store = reference_store.build_reference_store(
+        reference_store.bed_transcripts(str(path / "utrs.bed")), str(path / "genome.fa"), str(path / "store"))
+    return path, store
+
+def vcf_path(path, stream_vcf):
+    if stream_vcf:
+        return str(path / "variants.vcf")
+    pysam = pytest.importorskip("pysam")
+    gz_path = str(path / "variants.vcf.gz")
+    if not os.path.exists(gz_path):
+        pysam.tabix_index(str(path / "variants.vcf"), preset="vcf", keep_original=True)
+    return gz_path
+
+def items(path, vcf_file, stream_vcf, per_variant, store=None):
+    loader = dataloader.StrandedSequenceVariantDataloader(
+        str(path / "utrs.bed"), str(path / "genome.fa"), vcf_file, reference_store=store,
+        per_variant=per_variant, stream_vcf=stream_vcf)
+    return [loader[idx] for idx in range(len(loader))]
+
+# The store path gives the same reference and variant sequences as the fasta path (up to case:
+# VariantSeqExtractor keeps soft-masked bases lower case, the store is upper case)
+@pytest.mark.parametrize("per_variant", [False, True])
+@pytest.mark.parametrize("stream_vcf", [True, False])
+def test_reference_store_matches_fasta(fixture_files, stream_vcf, per_variant):
+    path, store = fixture_files
+    vcf_file = vcf_path(path, stream_vcf)
+    expected = items(path, vcf_file, stream_vcf, per_variant)
+    stored = items(path, vcf_file, stream_vcf, per_variant, store=store.path)
+    assert len(expected) == len(stored) > 0
+    overlapping = 0
+    for item, stored_item in zip(expected, stored):
+        assert item["metadata"] == stored_item["metadata"]
+        assert [seq.upper() for seq in item["inputs"]] == [seq.upper() for seq in stored_item["inputs"]]
+        overlapping += item["metadata"]["variants"].count(";") > 0
+    if not per_variant:
+        # the fixture exercises utrs with several (overlapping) variants
+        assert overlapping > 10
+
+def test_apply_variants_overlapping():
+    from kipoiseq.dataclasses import Variant
+    # split multi-allelic site at the last base: both alleles are inserted
+    assert reference_store.apply_variants("AGAGC", 463, [Variant("2", 468, "C", "A"),
+                                                         Variant("2", 468, "C", "G")]) == "AGAGAG"
+    # deletion with an SNV inside: the bases after the SNV come back
+    assert reference_store.apply_variants("ACGTAC", 100, [Variant("1", 101, "ACGT", "A"),
+                                                          Variant("1", 103, "G", "T")]) == "ATTAC"